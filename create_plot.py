@@ -6,6 +6,7 @@ But it can serve as inspiration for further development.
 
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image
 import torch
 import sys
 import os
@@ -16,7 +17,7 @@ import random
 from util import device
 
 class ImageGrid():
-    def __init__(self, width, height=1, cell_width = 3, cell_height = None, margin=0.2, create_viewer=True, crop=True):
+    def __init__(self, width, height=1, cell_width = 3, cell_height = None, margin=0.2, create_viewer=True, crop=True, use_render_cache=True):
         print("Plotting...")
         self.width = width
         self.height = height
@@ -34,6 +35,13 @@ class ImageGrid():
         else:
             self.viewer = None
 
+        # Rendered images are cached on disk, see rendering/render_cache.py
+        if use_render_cache:
+            from rendering.render_cache import RenderCache
+            self.render_cache = RenderCache()
+        else:
+            self.render_cache = None
+
     def set_image(self, image, x = 0, y = 0):
         cell = self.axes[y, x] if self.height > 1 and self.width > 1 else self.axes[x + y]
         cell.imshow(image)
@@ -43,8 +51,16 @@ class ImageGrid():
     def set_voxels(self, voxels, x = 0, y = 0, color=None):
         if color is not None:
             self.viewer.model_color = color
+        if self.render_cache is not None:
+            key = self.render_cache.get_key('voxels', voxels, self.viewer.model_color, self.viewer.rotation, self.viewer.size, self.crop)
+            image = self.render_cache.get(key)
+            if image is not None:
+                self.set_image(image, x, y)
+                return
         self.viewer.set_voxels(voxels)
         image = self.viewer.get_image(crop=self.crop)
+        if self.render_cache is not None:
+            self.render_cache.put(key, Image.fromarray(image))
         self.set_image(image, x, y)
 
     def save(self, filename):
@@ -77,6 +93,7 @@ def load_sdf_net(filename=None, return_latent_codes = False):
         sdf_net.filename = filename
     sdf_net.load()
     sdf_net.eval()
+    sdf_net.enable_cache(directory='data/sdf_net_cache')
 
     if return_latent_codes:
         latent_codes = torch.load(LATENT_CODES_FILENAME).to(device)
@@ -189,7 +206,7 @@ if "autoencoder-classes" in sys.argv:
 if "autodecoder-classes" in sys.argv:
     from dataset import dataset as dataset
     dataset.load_labels(device='cpu')
-    from rendering.raymarching import render_image
+    from rendering.raymarching import render_images
     from rendering import MeshRenderer
     import logging
     logging.getLogger('trimesh').setLevel(1000000)
@@ -208,6 +225,7 @@ if "autodecoder-classes" in sys.argv:
     
     plot = ImageGrid(COUNT, 2, create_viewer=False)
     dataset_directories = directories = open('data/models.txt', 'r').readlines()
+    images = render_images(sdf_net, latent_codes, color=[dataset.get_color(i) for i in range(COUNT)], crop=True, cache=plot.render_cache)
         
     for i in range(COUNT):
         mesh = trimesh.load(os.path.join(dataset_directories[index].strip(), 'model_normalized.obj'))
@@ -216,8 +234,7 @@ if "autodecoder-classes" in sys.argv:
         image = viewer.get_image(crop=True)
         plot.set_image(image, i, 0)
 
-        image = render_image(sdf_net, latent_codes[i, :], color=dataset.get_color(i), crop=True)
-        plot.set_image(image, i, 1)
+        plot.set_image(images[i][0], i, 1)
     viewer.delete_buffers()
     plot.save("plots/deepsdf-reconstruction-classes.pdf")
 
@@ -720,7 +737,7 @@ if 'sdf_net_reconstruction' in sys.argv:
     plot.save('plots/deepsdf-reconstruction.pdf')
 
 if "sdf_net_interpolation" in sys.argv:
-    from rendering.raymarching import render_image_for_index, render_image
+    from rendering.raymarching import render_images
     sdf_net, latent_codes = load_sdf_net(return_latent_codes=True)
     
     STEPS = 6
@@ -738,13 +755,13 @@ if "sdf_net_interpolation" in sys.argv:
 
     plot = ImageGrid(STEPS, create_viewer=False)
 
-    for i in range(STEPS):
-        plot.set_image(render_image(sdf_net, codes[i, :], crop=True), i)
+    for i, images in enumerate(render_images(sdf_net, codes, crop=True, cache=plot.render_cache)):
+        plot.set_image(images[0], i)
 
     plot.save("plots/deepsdf-interpolation.pdf")
 
 if "sdf_net_sample" in sys.argv:
-    from rendering.raymarching import render_image    
+    from rendering.raymarching import render_images
     sdf_net, latent_codes = load_sdf_net(return_latent_codes=True)
     latent_codes_flattened = latent_codes.detach().reshape(-1).cpu().numpy()
 
@@ -758,13 +775,13 @@ if "sdf_net_sample" in sys.argv:
     
     plot = ImageGrid(COUNT, create_viewer=False)
 
-    for i in range(COUNT):
-        plot.set_image(render_image(sdf_net, codes[i, :], crop=True), i)
+    for i, images in enumerate(render_images(sdf_net, codes, crop=True, cache=plot.render_cache)):
+        plot.set_image(images[0], i)
 
     plot.save("plots/deepsdf-samples.pdf")
     
 if "hybrid_gan" in sys.argv:
-    from rendering.raymarching import render_image
+    from rendering.raymarching import render_images
     from util import standard_normal_distribution
     generator = load_sdf_net(filename='hybrid_gan_generator.to')
 
@@ -774,14 +791,14 @@ if "hybrid_gan" in sys.argv:
     
     plot = ImageGrid(COUNT, create_viewer=False)
 
-    for i in range(COUNT):
-        plot.set_image(render_image(generator, codes[i, :], radius=1.6, crop=True, sdf_offset=-0.045, vertical_cutoff=1), i)
+    for i, images in enumerate(render_images(generator, codes, radius=1.6, crop=True, sdf_offset=-0.045, vertical_cutoff=1, cache=plot.render_cache)):
+        plot.set_image(images[0], i)
 
     plot.save("plots/hybrid-gan-samples.pdf")
 
 
 if "hybrid_gan_interpolation" in sys.argv:
-    from rendering.raymarching import render_image_for_index, render_image
+    from rendering.raymarching import render_images
     from util import standard_normal_distribution
     import cv2
     sdf_net = load_sdf_net(filename='hybrid_gan_generator.to')
@@ -789,9 +806,8 @@ if "hybrid_gan_interpolation" in sys.argv:
     OPTIONS = 10
     
     codes = standard_normal_distribution.sample([OPTIONS, LATENT_CODE_SIZE]).to(device)
-    for i in range(OPTIONS):
-        image = render_image(sdf_net, codes[i, :], resolution=200, radius=1.6, sdf_offset=-0.045, vertical_cutoff=1, crop=True)
-        image.save('plots/option-{:d}.png'.format(i))
+    for i, images in enumerate(render_images(sdf_net, codes, resolution=200, radius=1.6, sdf_offset=-0.045, vertical_cutoff=1, crop=True)):
+        images[0].save('plots/option-{:d}.png'.format(i))
     
     STEPS = 6
         
@@ -805,8 +821,8 @@ if "hybrid_gan_interpolation" in sys.argv:
 
     plot = ImageGrid(STEPS, create_viewer=False)
     
-    for i in range(STEPS):
-        plot.set_image(render_image(sdf_net, codes[i, :], crop=True, radius=1.6, sdf_offset=-0.045, vertical_cutoff=1), i)
+    for i, images in enumerate(render_images(sdf_net, codes, crop=True, radius=1.6, sdf_offset=-0.045, vertical_cutoff=1, cache=plot.render_cache)):
+        plot.set_image(images[0], i)
 
     plot.save("plots/hybrid-gan-interpolation.pdf")
 
@@ -831,7 +847,7 @@ if "hybrid_gan_upscaling" in sys.argv:
     voxels_128 = sdf_net.get_voxels(code, 128, sphere_only=False)
     plot.set_voxels(voxels_128, 2)
 
-    plot.set_image(render_image(sdf_net, code, radius=1.6, crop=True, vertical_cutoff=1, sdf_offset=-0.045), 3)
+    plot.set_image(render_image(sdf_net, code, radius=1.6, crop=True, vertical_cutoff=1, sdf_offset=-0.045, cache=plot.render_cache), 3)
 
     plot.save("plots/hybrid-gan-upscaling.pdf")
 
@@ -905,7 +921,7 @@ if 'sdf_checkpoints' in sys.argv:
         sdf_net.load_state_dict(torch.load(os.path.join(CHECKPOINT_PATH, checkpoints_network[i])))
         latent_codes = torch.load(os.path.join(CHECKPOINT_PATH, checkpoints_latent_codes[i])).detach()
         latent_code = latent_codes[MODEL_INDEX, :]
-        plot.set_image(render_image(sdf_net, latent_code, crop=True), i)
+        plot.set_image(render_image(sdf_net, latent_code, crop=True, cache=plot.render_cache), i)
 
     plot.save('plots/deepsdf-checkpoints.pdf')
 
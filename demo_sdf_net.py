@@ -90,7 +90,7 @@ def create_objects():
         latent_code = standard_normal_distribution.sample((LATENT_CODE_SIZE,)).to(device)
         image = render_image(sdf_net, latent_code, resolution=128, sdf_offset=-SURFACE_LEVEL, ssaa=2, radius=1.4, color=(0.7, 0.7, 0.7))
         image.save(image_filename.format(index))
-        mesh = sdf_net.get_mesh(latent_code, voxel_resolution=256, sphere_only=False, level=SURFACE_LEVEL)
+        mesh = sdf_net.get_mesh(latent_code, voxel_resolution=256, sphere_only=False, level=SURFACE_LEVEL, adaptive=True)
         mesh.apply_transform(get_rotation_matrix(90, 'x'))
         mesh.apply_translation((0, 0, -np.min(mesh.vertices[:, 2])))
         mesh.export(mesh_filename.format(index))
@@ -0,0 +1,121 @@
+import torch
+import torch.optim as optim
+
+import numpy as np
+from itertools import count
+import time
+import sys
+
+from model.sdf_net import SDFNet, LATENT_CODE_SIZE, LATENT_CODES_FILENAME
+from util import device, standard_normal_distribution
+from inference_accuracy import get_fixed_latent_codes, get_surface_report, print_report
+
+# Trains a smaller SDFNet (the student) to reproduce the output of a trained SDFNet (the teacher).
+# The student is saved like any other SDFNet and can be loaded by setting sdf_net.filename, since SDFNet.load
+# takes the breadth and depth from the file.
+#
+# Usage:
+#   python3 distill_sdf_net.py teacher=hybrid_gan_generator.to breadth=128 depth=6 latents=prior
+# Use latents=autodecoder to train on the latent codes of the autodecoder instead of the GAN prior.
+# Add "continue" to continue training the student and "report" to only print the report.
+
+def get_parameter(name, default):
+    for arg in sys.argv:
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return default
+
+TEACHER_FILENAME = get_parameter('teacher', 'hybrid_gan_generator.to')
+BREADTH = int(get_parameter('breadth', 128))
+DEPTH = int(get_parameter('depth', 6))
+LATENTS = get_parameter('latents', 'prior')
+STUDENT_FILENAME = get_parameter('student', '{:s}-student-{:d}x{:d}.to'.format(TEACHER_FILENAME.split('.')[0], BREADTH, DEPTH))
+
+BATCH_SIZE = 16 # latent codes per batch
+POINTS_PER_SHAPE = 4096
+# A quarter of the points is sampled uniformly, the rest are the candidates closest to the surface out of this many
+CANDIDATES_PER_SHAPE = POINTS_PER_SHAPE * 4
+SDF_CUTOFF = 0.1
+STEPS_PER_EPOCH = 500
+# Noise added to the autodecoder latent codes so that the student also learns the space between them
+LATENT_CODE_NOISE = 0.1
+
+LOG_FILE_NAME = "plots/sdf_net_distillation.csv"
+
+teacher = SDFNet()
+teacher.filename = TEACHER_FILENAME
+teacher.load()
+teacher.eval()
+
+student = SDFNet(breadth=BREADTH, depth=DEPTH)
+student.filename = STUDENT_FILENAME
+if 'continue' in sys.argv or 'report' in sys.argv:
+    student.load()
+
+if LATENTS == 'autodecoder':
+    autodecoder_latent_codes = torch.load(LATENT_CODES_FILENAME).to(device)
+
+def sample_latent_codes():
+    if LATENTS == 'autodecoder':
+        indices = torch.randint(autodecoder_latent_codes.shape[0], (BATCH_SIZE,), device=device)
+        return autodecoder_latent_codes[indices, :] + torch.randn((BATCH_SIZE, LATENT_CODE_SIZE), device=device) * LATENT_CODE_NOISE
+    else:
+        return standard_normal_distribution.sample((BATCH_SIZE, LATENT_CODE_SIZE)).to(device)
+
+def sample_points(latent_codes):
+    # Returns points of shape (batch size, points per shape, 3) and the SDF values of the teacher at these points
+    with torch.no_grad():
+        candidates = torch.rand((BATCH_SIZE, CANDIDATES_PER_SHAPE, 3), device=device) * 2 - 1
+        candidate_sdf = teacher(candidates, latent_codes)
+        surface_point_count = POINTS_PER_SHAPE * 3 // 4
+        indices = torch.topk(torch.abs(candidate_sdf), surface_point_count, dim=1, largest=False)[1]
+        surface_points = torch.gather(candidates, 1, indices.unsqueeze(2).expand(-1, -1, 3))
+        surface_points += torch.randn_like(surface_points) * 0.01
+        uniform_points = candidates[:, :POINTS_PER_SHAPE - surface_point_count, :]
+        points = torch.cat((surface_points, uniform_points), dim=1)
+        return points, teacher(points, latent_codes)
+
+def report():
+    if device.type == 'cuda':
+        print('Timings are measured on the GPU. Run on a CPU-only machine for the CPU speedup.')
+    print_report(get_surface_report(teacher, student, get_fixed_latent_codes(32), voxel_resolution=64))
+
+def train():
+    optimizer = optim.Adam(student.parameters(), lr=1e-4)
+    first_epoch = 0
+    if 'continue' in sys.argv:
+        first_epoch = len(open(LOG_FILE_NAME, 'r').readlines())
+    log_file = open(LOG_FILE_NAME, "a" if "continue" in sys.argv else "w")
+
+    for epoch in count(start=first_epoch):
+        epoch_start_time = time.time()
+        loss_values = []
+        student.train()
+        for _ in range(STEPS_PER_EPOCH):
+            latent_codes = sample_latent_codes()
+            points, teacher_sdf = sample_points(latent_codes)
+
+            student.zero_grad()
+            output = student(points, latent_codes)
+            loss = torch.mean(torch.abs(output.clamp(-SDF_CUTOFF, SDF_CUTOFF) - teacher_sdf.clamp(-SDF_CUTOFF, SDF_CUTOFF)))
+            loss.backward()
+            optimizer.step()
+            loss_values.append(loss.item())
+
+        epoch_duration = time.time() - epoch_start_time
+        print("Epoch {:d}, {:.1f}s. Loss: {:.8f}".format(epoch, epoch_duration, np.mean(loss_values)))
+        student.save()
+        student.save(epoch=epoch)
+        log_file.write('{:d} {:.1f} {:.6f}\n'.format(epoch, epoch_duration, np.mean(loss_values)))
+        log_file.flush()
+
+        if epoch % 10 == 0:
+            student.eval()
+            report()
+
+
+if 'report' in sys.argv:
+    student.eval()
+    report()
+else:
+    train()
@@ -0,0 +1,143 @@
+import torch
+import numpy as np
+import glob
+import os
+import re
+import sys
+import time
+import csv
+
+from model.sdf_net import SDFNet, LATENT_CODE_SIZE
+from util import device, ensure_directory
+from metrics import create_worker_pool, submit_point_cloud_sampling, collect_point_clouds, sample_from_voxels
+from point_cloud_metrics import get_metrics
+
+# Watches the checkpoint directory and evaluates new SDFNet checkpoints while training is running.
+# Every checkpoint is evaluated with the same latent codes against the same reference point clouds.
+# The results are appended to a CSV file and checkpoints that are already in the file are skipped,
+# so the watcher can be stopped and restarted at any time.
+#
+# Usage:
+#   python3 evaluate_checkpoints.py pattern=models/checkpoints/hybrid_progressive_gan_generator_3-epoch-*.to dataset=data/chairs/voxels_64 split=data/chairs/val.txt
+# Further parameters: results=plots/checkpoint_metrics.csv, reference=data/checkpoint_evaluation_reference.npy,
+# count=100, point_count=2048, resolution=64, seed=1234, interval=60
+# Add "once" to evaluate the existing checkpoints and exit instead of waiting for new ones and "emd" to also compute the EMD metrics.
+
+# A checkpoint is only read once it hasn't been modified for this many seconds, so that files that are being written are skipped
+MIN_CHECKPOINT_AGE = 10
+
+def get_parameter(name, default):
+    for arg in sys.argv:
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return default
+
+PATTERN = get_parameter('pattern', os.path.join('models', 'checkpoints', '*-epoch-*.to'))
+RESULTS_FILENAME = get_parameter('results', os.path.join('plots', 'checkpoint_metrics.csv'))
+REFERENCE_FILENAME = get_parameter('reference', os.path.join('data', 'checkpoint_evaluation_reference.npy'))
+SAMPLE_COUNT = int(get_parameter('count', 100))
+POINT_CLOUD_SIZE = int(get_parameter('point_count', 2048))
+VOXEL_RESOLUTION = int(get_parameter('resolution', 64))
+SEED = int(get_parameter('seed', 1234))
+POLL_INTERVAL = float(get_parameter('interval', 60))
+DISTANCES = ('chamfer', 'emd') if 'emd' in sys.argv else ('chamfer',)
+
+def get_reference_point_clouds():
+    # The reference point clouds are sampled from the dataset once and then loaded from the file
+    if os.path.exists(REFERENCE_FILENAME):
+        return np.load(REFERENCE_FILENAME)
+    from datasets import VoxelDataset
+    dataset = VoxelDataset.from_split(os.path.join(get_parameter('dataset', 'data/chairs/voxels_64'), '{:s}.npy'), get_parameter('split', 'data/chairs/val.txt'))
+    generator = torch.Generator().manual_seed(SEED)
+    indices = torch.randperm(len(dataset), generator=generator)[:SAMPLE_COUNT]
+    voxels = np.stack([np.asarray(dataset[i]) for i in indices.tolist()])
+    clouds = sample_from_voxels(voxels, POINT_CLOUD_SIZE, seed=SEED)
+    ensure_directory(os.path.dirname(REFERENCE_FILENAME))
+    np.save(REFERENCE_FILENAME, clouds)
+    return clouds
+
+def get_evaluated_checkpoints():
+    if not os.path.exists(RESULTS_FILENAME):
+        return set()
+    with open(RESULTS_FILENAME, 'r') as file:
+        return set(row['checkpoint'] for row in csv.DictReader(file))
+
+def append_result(row):
+    is_new_file = not os.path.exists(RESULTS_FILENAME)
+    if not is_new_file:
+        with open(RESULTS_FILENAME, 'r') as file:
+            columns = next(csv.reader(file))
+        if columns != list(row.keys()):
+            raise ValueError('The columns of {:s} don\'t match the computed metrics. Use a different results file.'.format(RESULTS_FILENAME))
+    with open(RESULTS_FILENAME, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(row.keys()))
+        if is_new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+def get_epoch(filename):
+    match = re.search(r'-epoch-(\d+)\.to$', filename)
+    return int(match.group(1)) if match is not None else -1
+
+def get_new_checkpoints(evaluated, skipped):
+    now = time.time()
+    filenames = [filename for filename in glob.glob(PATTERN) if filename not in evaluated and filename not in skipped]
+    filenames = [filename for filename in filenames if now - os.path.getmtime(filename) > MIN_CHECKPOINT_AGE]
+    return sorted(filenames, key=lambda filename: (get_epoch(filename), filename))
+
+def load_checkpoint(filename):
+    # Returns None for checkpoints of other networks, such as discriminators, and for other files, such as latent codes.
+    # These are skipped for good, while files that fail to load are tried again.
+    state_dict = torch.load(filename, map_location=device)
+    if not isinstance(state_dict, dict) or 'layers1.0.weight' not in state_dict:
+        return None
+    sdf_net = SDFNet(device=device)
+    sdf_net.load_parameters(state_dict)
+    sdf_net.eval()
+    return sdf_net
+
+def evaluate(sdf_net, latent_codes, reference_clouds, pool):
+    results = submit_point_cloud_sampling(pool, sdf_net, SAMPLE_COUNT, POINT_CLOUD_SIZE, voxel_resolution=VOXEL_RESOLUTION, latent_codes=latent_codes, seed=SEED)
+    clouds = collect_point_clouds(results, POINT_CLOUD_SIZE)
+    return get_metrics(clouds, reference_clouds, distances=DISTANCES)
+
+def watch():
+    ensure_directory(os.path.dirname(RESULTS_FILENAME))
+    reference_clouds = get_reference_point_clouds()
+    generator = torch.Generator().manual_seed(SEED)
+    latent_codes = torch.randn((SAMPLE_COUNT, LATENT_CODE_SIZE), generator=generator).to(device)
+    pool = create_worker_pool()
+
+    evaluated = get_evaluated_checkpoints()
+    skipped = set()
+    print("{:d} checkpoints have already been evaluated.".format(len(evaluated)))
+    while True:
+        for filename in get_new_checkpoints(evaluated, skipped):
+            try:
+                sdf_net = load_checkpoint(filename)
+            except (RuntimeError, EOFError) as exception:
+                # Incomplete files are tried again in the next round
+                print("Could not load {:s}: {:s}".format(filename, str(exception)))
+                continue
+            if sdf_net is None:
+                skipped.add(filename)
+                continue
+
+            start_time = time.time()
+            metrics = evaluate(sdf_net, latent_codes, reference_clouds, pool)
+            row = {'checkpoint': filename, 'epoch': get_epoch(filename)}
+            row.update(metrics)
+            append_result(row)
+            evaluated.add(filename)
+            print("Evaluated {:s} in {:.1f}s: ".format(filename, time.time() - start_time) + ', '.join('{:s} {:.6f}'.format(key, value) for key, value in metrics.items()))
+
+        if 'once' in sys.argv:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+    watch()
@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+import copy
+import os
+import sys
+from model import LATENT_CODE_SIZE
+from exported_model import EXPORT_PATH, get_exported_filename
+
+# Writes TorchScript versions of the generator networks that can be loaded with exported_model.load_exported_model.
+# The models are traced in eval mode and frozen, which inlines the parameters. Batch norm layers after transposed convolutions
+# are folded into the convolutions by hand before tracing, since the folding of torch.jit.freeze only handles regular convolutions.
+#
+# Usage:
+#   python3 export_models.py sdf_net filename=hybrid_gan_generator.to
+#   python3 export_models.py point_sdf_net filename=point_sdf_generator.to
+#   python3 export_models.py gan
+#   python3 export_models.py autoencoder
+
+EXAMPLE_BATCH_SIZE = 2
+EXAMPLE_POINT_COUNT = 1000
+
+def get_parameter(name, default):
+    for arg in sys.argv:
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return default
+
+class SDFNetExport(nn.Module):
+    # Evaluates the SDFNet with the latent codes folded into the biases of its input layers
+    def __init__(self, sdf_net):
+        super(SDFNetExport, self).__init__()
+        self.sdf_net = sdf_net
+
+    def forward(self, points, latent_codes):
+        bias1, bias2 = self.sdf_net.get_latent_biases(latent_codes)
+        sdf = self.sdf_net.forward_with_latent_biases(points, (bias1.unsqueeze(1), bias2.unsqueeze(1)))
+        return sdf.reshape(points.shape[0], points.shape[1])
+
+class SDFGeneratorExport(nn.Module):
+    def __init__(self, generator):
+        super(SDFGeneratorExport, self).__init__()
+        self.generator = generator
+
+    def forward(self, points, latent_codes):
+        return self.generator(points, latent_codes).squeeze(-1)
+
+def fold_batch_norm(module):
+    # Returns a copy of the module in eval mode in which every BatchNorm3d that directly follows a ConvTranspose3d
+    # in a Sequential is merged into the weights and bias of the convolution and replaced by an identity.
+    module = copy.deepcopy(module).eval()
+    for sequential in [child for child in module.modules() if isinstance(child, nn.Sequential)]:
+        for i in range(1, len(sequential)):
+            convolution, batch_norm = sequential[i - 1], sequential[i]
+            if not isinstance(convolution, nn.ConvTranspose3d) or not isinstance(batch_norm, nn.BatchNorm3d) or batch_norm.running_var is None:
+                continue
+            with torch.no_grad():
+                scale = 1 / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+                shift = -batch_norm.running_mean * scale
+                if batch_norm.affine:
+                    scale = scale * batch_norm.weight
+                    shift = shift * batch_norm.weight + batch_norm.bias
+                # The weight of a transposed convolution has the shape (in channels, out channels / groups, ...)
+                weight = convolution.weight.reshape(convolution.groups, -1, convolution.out_channels // convolution.groups, *convolution.kernel_size)
+                weight *= scale.reshape(convolution.groups, 1, -1, 1, 1, 1)
+                bias = convolution.bias if convolution.bias is not None else torch.zeros_like(scale)
+                convolution.bias = nn.Parameter(bias * scale + shift)
+            sequential[i] = nn.Identity()
+    return module
+
+def export(module, example_inputs, name):
+    module = fold_batch_norm(module)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs, check_trace=True)
+        frozen = torch.jit.freeze(traced)
+    if not os.path.exists(EXPORT_PATH):
+        os.makedirs(EXPORT_PATH)
+    frozen.save(get_exported_filename(name))
+    print('Saved {:s}.'.format(get_exported_filename(name)))
+    return frozen
+
+def get_example_sdf_inputs(device, latent_code_size=LATENT_CODE_SIZE):
+    points = torch.rand((EXAMPLE_BATCH_SIZE, EXAMPLE_POINT_COUNT, 3), device=device) * 2 - 1
+    latent_codes = torch.randn((EXAMPLE_BATCH_SIZE, latent_code_size), device=device)
+    return points, latent_codes
+
+def get_example_latent_codes(device):
+    return torch.randn((EXAMPLE_BATCH_SIZE, LATENT_CODE_SIZE), device=device)
+
+def export_sdf_net(sdf_net, name):
+    return export(SDFNetExport(sdf_net), get_example_sdf_inputs(sdf_net.device), name)
+
+def export_sdf_generator(generator, name):
+    device = next(generator.parameters()).device
+    return export(SDFGeneratorExport(generator), get_example_sdf_inputs(device, generator.latent_channels), name)
+
+def export_voxel_generator(generator, name):
+    device = next(generator.parameters()).device
+    return export(generator, (get_example_latent_codes(device),), name)
+
+
+if 'sdf_net' in sys.argv:
+    from model.sdf_net import SDFNet
+    sdf_net = SDFNet()
+    sdf_net.filename = get_parameter('filename', sdf_net.filename)
+    sdf_net.load()
+    export_sdf_net(sdf_net, sdf_net.filename.split('.')[0])
+
+if 'point_sdf_net' in sys.argv:
+    from model.point_sdf_net import SDFGenerator
+    # Same hyperparameters as in train_point_gan.py
+    generator = SDFGenerator(LATENT_CODE_SIZE, 256, 8, True, dropout=0.0)
+    filename = get_parameter('filename', 'point_sdf_generator.to')
+    generator.load_state_dict(torch.load(os.path.join('models', filename)))
+    export_sdf_generator(generator, filename.split('.')[0])
+
+if 'gan' in sys.argv:
+    from model.gan import Generator
+    generator = Generator()
+    generator.filename = get_parameter('filename', generator.filename)
+    generator.load()
+    export_voxel_generator(generator, generator.filename.split('.')[0])
+
+if 'autoencoder' in sys.argv:
+    from model.autoencoder import Autoencoder
+    autoencoder = Autoencoder(is_variational='classic' not in sys.argv)
+    autoencoder.filename = get_parameter('filename', autoencoder.filename)
+    autoencoder.load()
+    export_voxel_generator(autoencoder.decoder, autoencoder.filename.split('.')[0] + '-decoder')
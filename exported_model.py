@@ -0,0 +1,28 @@
+import torch
+import os
+
+# Loads the TorchScript models written by export_models.py.
+# This only depends on torch, so generation workers don't need to import the model classes, trimesh or skimage.
+#
+# The exported models take these inputs:
+# SDF networks (SDFNet, SDFGenerator): points (batch size, point count, 3), latent codes (batch size, latent code size) -> SDF (batch size, point count)
+# Voxel generators (gan.Generator, Autoencoder.decoder): latent codes (batch size, latent code size) -> voxels (batch size, 1, 32, 32, 32)
+
+EXPORT_PATH = os.path.join('models', 'exported')
+
+def get_exported_filename(name):
+    return os.path.join(EXPORT_PATH, name + '.pt')
+
+def load_exported_model(name, device='cpu'):
+    model = torch.jit.load(get_exported_filename(name), map_location=device)
+    model.eval()
+    return model
+
+def evaluate_exported_sdf_in_batches(model, points, latent_code, batch_size=100000):
+    # Evaluates an exported SDF network for a single latent code at points of shape (point count, 3)
+    result = torch.zeros(points.shape[0], device=points.device)
+    latent_codes = latent_code.reshape(1, -1)
+    with torch.no_grad():
+        for start in range(0, points.shape[0], batch_size):
+            result[start:start + batch_size] = model(points[start:start + batch_size, :].unsqueeze(0), latent_codes)[0, :]
+    return result
@@ -0,0 +1,147 @@
+import torch
+import numpy as np
+import os
+import sys
+import time
+import trimesh
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from model.sdf_net import SDFNet, LATENT_CODE_SIZE, get_meshes_from_voxels
+from util import device, ensure_directory
+
+# Generates meshes for many latent codes.
+# The network evaluates the SDF volumes for a batch of shapes in the main process, while marching cubes,
+# mesh cleanup and export of the previous batches run in a pool of worker processes.
+# Existing files are skipped, so an interrupted run can be resumed by running the same command again.
+#
+# Usage:
+#   python3 generate_meshes.py checkpoint=hybrid_gan_generator.to count=1000 resolution=128 format=stl
+#   python3 generate_meshes.py checkpoint=hybrid_gan_generator.to latent_codes=data/latent_codes.npy
+# Further parameters: output=generated_meshes, level=0, batch_size=8, workers=<cpu count>, seed=0
+# Add "orient" to rotate the meshes to z-up and place them on the ground, as in demo_sdf_net.create_objects.
+
+# Connected components with less than this fraction of the faces of the mesh are removed
+MIN_COMPONENT_FRACTION = 0.01
+
+def get_parameter(name, default):
+    for arg in sys.argv:
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return default
+
+def load_latent_codes(filename):
+    if filename.endswith('.npy'):
+        return torch.tensor(np.load(filename), dtype=torch.float32)
+    return torch.load(filename, map_location='cpu').detach().to(torch.float32)
+
+def get_latent_codes(output_directory, count, seed, latent_codes_filename=None):
+    # Generated latent codes are saved with the meshes, so that a resumed run continues with the same codes
+    if latent_codes_filename is not None:
+        return load_latent_codes(latent_codes_filename)
+    filename = os.path.join(output_directory, 'latent_codes.npy')
+    if os.path.exists(filename):
+        latent_codes = load_latent_codes(filename)
+        if latent_codes.shape[0] != count:
+            raise ValueError('{:s} contains {:d} latent codes, but count is {:d}.'.format(filename, latent_codes.shape[0], count))
+        return latent_codes
+    generator = torch.Generator().manual_seed(seed)
+    latent_codes = torch.randn((count, LATENT_CODE_SIZE), generator=generator)
+    np.save(filename, latent_codes.numpy())
+    return latent_codes
+
+def clean_mesh(mesh):
+    mesh.update_faces(mesh.nondegenerate_faces())
+    components = mesh.split(only_watertight=False)
+    if len(components) > 1:
+        min_face_count = MIN_COMPONENT_FRACTION * mesh.faces.shape[0]
+        # The largest component is always kept, even if all components are below the threshold
+        largest_component = max(components, key=lambda component: component.faces.shape[0])
+        mesh = trimesh.util.concatenate([component for component in components if component is largest_component or component.faces.shape[0] >= min_face_count])
+    mesh.remove_unreferenced_vertices()
+    return mesh
+
+def orient_mesh(mesh):
+    # Same as rendering.math.get_rotation_matrix(90, 'x'), without importing the rendering package in the workers
+    mesh.apply_transform(trimesh.transformations.rotation_matrix(np.pi / 2, (1, 0, 0)))
+    mesh.apply_translation((0, 0, -np.min(mesh.vertices[:, 2])))
+
+def initialize_worker():
+    # Each worker uses one thread, the parallelism comes from the number of processes
+    torch.set_num_threads(1)
+
+def process_shape(voxels, voxel_resolution, level, filename, empty_filename, orient):
+    mesh = get_meshes_from_voxels(voxels[np.newaxis, :, :, :], voxel_resolution, level=level)[0]
+    if mesh is None:
+        open(empty_filename, 'w').close()
+        return False
+    mesh = clean_mesh(mesh)
+    if orient:
+        orient_mesh(mesh)
+    # Write to a temporary file first so that an interrupted run never leaves an incomplete mesh
+    extension = os.path.splitext(filename)[1]
+    temporary_filename = filename[:-len(extension)] + '.tmp' + extension
+    mesh.export(temporary_filename)
+    os.replace(temporary_filename, filename)
+    return True
+
+def generate_meshes(sdf_net, latent_codes, output_directory, voxel_resolution=128, file_format='stl', level=0, batch_size=8, worker_count=None, orient=False):
+    ensure_directory(output_directory)
+    filenames = [os.path.join(output_directory, 'shape-{:05d}.{:s}'.format(i, file_format)) for i in range(latent_codes.shape[0])]
+    empty_filenames = [os.path.join(output_directory, 'shape-{:05d}.empty'.format(i)) for i in range(latent_codes.shape[0])]
+    indices = [i for i in range(latent_codes.shape[0]) if not os.path.exists(filenames[i]) and not os.path.exists(empty_filenames[i])]
+    print("{:d} of {:d} shapes already exist.".format(latent_codes.shape[0] - len(indices), latent_codes.shape[0]))
+    if len(indices) == 0:
+        return
+
+    if worker_count is None:
+        worker_count = os.cpu_count()
+    print("Using {:d} processes.".format(worker_count))
+    pool = Pool(worker_count, initializer=initialize_worker)
+
+    progress = tqdm(total=len(indices))
+    def on_complete(*_):
+        progress.update()
+
+    start_time = time.time()
+    pending = []
+    empty_count = 0
+    for batch_start in range(0, len(indices), batch_size):
+        batch_indices = indices[batch_start:batch_start + batch_size]
+        with torch.no_grad():
+            voxels = sdf_net.get_voxels(latent_codes[batch_indices, :].to(sdf_net.device), voxel_resolution, sphere_only=False, level=level)
+
+        # Limit the number of queued volumes, so that the network doesn't run too far ahead of the workers
+        while len(pending) > 2 * worker_count:
+            empty_count += not pending.pop(0).get()
+
+        for i, index in enumerate(batch_indices):
+            pending.append(pool.apply_async(process_shape, args=(voxels[i, :, :, :], voxel_resolution, level, filenames[index], empty_filenames[index], orient), callback=on_complete))
+
+    for result in pending:
+        empty_count += not result.get()
+    pool.close()
+    pool.join()
+    progress.close()
+
+    duration = time.time() - start_time
+    print("Generated {:d} shapes in {:.1f}s ({:.2f} shapes per second), {:d} with empty surfaces.".format(len(indices), duration, len(indices) / duration, empty_count))
+
+
+if __name__ == '__main__':
+    sdf_net = SDFNet()
+    sdf_net.filename = get_parameter('checkpoint', 'hybrid_gan_generator.to')
+    sdf_net.load()
+    sdf_net.eval()
+
+    output_directory = get_parameter('output', 'generated_meshes')
+    ensure_directory(output_directory)
+    latent_codes = get_latent_codes(output_directory, int(get_parameter('count', 100)), int(get_parameter('seed', 0)), latent_codes_filename=get_parameter('latent_codes', None))
+
+    generate_meshes(sdf_net, latent_codes, output_directory,
+        voxel_resolution=int(get_parameter('resolution', 128)),
+        file_format=get_parameter('format', 'stl'),
+        level=float(get_parameter('level', 0)),
+        batch_size=int(get_parameter('batch_size', 8)),
+        worker_count=int(get_parameter('workers', os.cpu_count())),
+        orient='orient' in sys.argv)
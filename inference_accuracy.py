@@ -0,0 +1,167 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+import time
+import sys
+from model.sdf_net import SDFNet, LATENT_CODE_SIZE
+from marching_cubes import marching_cubes
+from util import device, evaluate_on_grid, sample_surface_points
+
+# Compares approximated SDF inference (such as reduced precision or quantization) against the float32 model
+# on a fixed set of latent codes. Works with SDFNet and with the SDFGenerator of the point GAN.
+# Also checks that the ray marcher renders the same images regardless of its tile size.
+
+def get_fixed_latent_codes(count, latent_code_size=LATENT_CODE_SIZE, seed=1234):
+    # Independent of the global random state, so that reports from different runs are comparable
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn((count, latent_code_size), generator=generator).to(device)
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def _evaluate_timed(model, latent_codes, voxel_resolution):
+    evaluate_on_grid(model, latent_codes[:1, :], 16) # warm up
+    _synchronize(latent_codes.device)
+    start = time.perf_counter()
+    values = evaluate_on_grid(model, latent_codes, voxel_resolution)
+    _synchronize(latent_codes.device)
+    return values, time.perf_counter() - start
+
+def get_precision_report(model, dtype, latent_codes, voxel_resolution=64, level=0):
+    ''' Evaluates the model on a voxel grid for each latent code, once in float32 and once with the given inference_dtype.
+    The model should be in eval mode, since the inference_dtype is ignored in training mode. '''
+    previous_dtype = model.inference_dtype
+    try:
+        model.inference_dtype = None
+        reference, reference_time = _evaluate_timed(model, latent_codes, voxel_resolution)
+        model.inference_dtype = dtype
+        values, reduced_time = _evaluate_timed(model, latent_codes, voxel_resolution)
+    finally:
+        model.inference_dtype = previous_dtype
+
+    error = torch.abs(values - reference)
+    sign_flips = (values < level) != (reference < level)
+    # Voxels within two voxel sizes of the surface are the ones that affect the mesh
+    near_surface = torch.abs(reference - level) < 2 * 2 / (voxel_resolution - 1)
+
+    return {
+        'dtype': str(dtype),
+        'max_error': error.max().item(),
+        'mean_error': error.mean().item(),
+        'near_surface_max_error': error[near_surface].max().item() if near_surface.any() else 0.0,
+        'sign_flips': sign_flips.sum().item(),
+        'sign_flip_rate': sign_flips.float().mean().item(),
+        'reference_time': reference_time,
+        'time': reduced_time,
+        'speedup': reference_time / reduced_time
+    }
+
+def get_chamfer_distance(points1, points2):
+    # Mean distance from each point to the nearest point of the other set, averaged over both directions
+    distances = torch.cdist(points1, points2)
+    return (distances.min(dim=1)[0].mean() + distances.min(dim=0)[0].mean()).item() / 2
+
+def _get_surface_points(values, voxel_resolution, level, point_count, seed):
+    # Meshes are extracted like in SDFNet.get_mesh and placed in the [-1, 1] cube
+    size = 2
+    voxels = F.pad(values.reshape(-1, voxel_resolution, voxel_resolution, voxel_resolution), (1, 1, 1, 1, 1, 1), mode='constant', value=1)
+    meshes = marching_cubes(voxels, level=level, spacing=(size / voxel_resolution,) * 3)
+    result = []
+    for i, (vertices, faces, _) in enumerate(meshes):
+        if faces.shape[0] == 0:
+            result.append(None)
+            continue
+        generator = torch.Generator().manual_seed(seed + i)
+        result.append(sample_surface_points(vertices - size / 2, faces, point_count, generator=generator))
+    return result
+
+def get_surface_report(reference_model, model, latent_codes, voxel_resolution=64, level=0, point_count=2048, seed=1234):
+    ''' Compares the surfaces of two models for each latent code.
+    The IoU is computed between the insides of the surfaces on the voxel grid and the
+    Chamfer distance between points sampled from the marching cubes meshes. '''
+    reference, reference_time = _evaluate_timed(reference_model, latent_codes, voxel_resolution)
+    values, model_time = _evaluate_timed(model, latent_codes, voxel_resolution)
+
+    reference_inside = reference < level
+    inside = values < level
+    intersection = (reference_inside & inside).sum(dim=1).float()
+    union = (reference_inside | inside).sum(dim=1).float()
+    iou = torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(union))
+
+    reference_points = _get_surface_points(reference, voxel_resolution, level, point_count, seed)
+    points = _get_surface_points(values, voxel_resolution, level, point_count, seed)
+    chamfer_distances = []
+    empty_surfaces = 0
+    for reference_cloud, cloud in zip(reference_points, points):
+        if reference_cloud is None or cloud is None:
+            empty_surfaces += 1
+            continue
+        chamfer_distances.append(get_chamfer_distance(reference_cloud, cloud))
+    chamfer_distances = torch.tensor(chamfer_distances)
+
+    return {
+        'iou': iou.mean().item(),
+        'min_iou': iou.min().item(),
+        'chamfer_distance': chamfer_distances.mean().item() if len(chamfer_distances) > 0 else float('nan'),
+        'max_chamfer_distance': chamfer_distances.max().item() if len(chamfer_distances) > 0 else float('nan'),
+        'empty_surfaces': empty_surfaces,
+        'reference_time': reference_time,
+        'time': model_time,
+        'speedup': reference_time / model_time
+    }
+
+def get_tiling_report(sdf_net, latent_codes, tile_sizes=(2**20, 5000, 777), resolution=128):
+    ''' Renders the latent codes with each tile size and compares the images to those of the first tile size.
+    The rays of a tile are traced independently of the other tiles, so all images should be identical. '''
+    from rendering.raymarching import render_images
+    images = [render_images(sdf_net, latent_codes, resolution=resolution, ssaa=1, tile_size=tile_size) for tile_size in tile_sizes]
+    report = {}
+    for tile_size, tile_images in zip(tile_sizes[1:], images[1:]):
+        differences = [np.abs(np.asarray(image, dtype=int) - np.asarray(reference, dtype=int)).max(axis=2)
+            for shape_images, reference_images in zip(tile_images, images[0]) for image, reference in zip(shape_images, reference_images)]
+        report['max_difference_{:d}'.format(tile_size)] = int(max(difference.max() for difference in differences))
+        report['different_pixels_{:d}'.format(tile_size)] = int(sum((difference > 0).sum() for difference in differences))
+    return report
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            print('{:s}: {:.6g}'.format(key, value))
+        else:
+            print('{:s}: {:s}'.format(key, str(value)))
+
+
+if 'precision' in sys.argv:
+    sdf_net = SDFNet()
+    sdf_net.filename = 'hybrid_gan_generator.to'
+    sdf_net.load()
+    sdf_net.eval()
+
+    latent_codes = get_fixed_latent_codes(16)
+    for dtype in (torch.bfloat16, torch.float16):
+        print_report(get_precision_report(sdf_net, dtype, latent_codes, voxel_resolution=64))
+        print('')
+
+if 'quantization' in sys.argv:
+    from model.quantization import quantize
+    sdf_net = SDFNet(device='cpu')
+    sdf_net.filename = 'hybrid_gan_generator.to'
+    sdf_net.load_state_dict(torch.load(sdf_net.get_filename(), map_location='cpu'), strict=False)
+    sdf_net.eval()
+
+    quantized_sdf_net = quantize(sdf_net, get_fixed_latent_codes(8, seed=4321).cpu())
+    print('Quantized layers: ' + ', '.join(quantized_sdf_net.quantized_layers))
+    print_report(get_surface_report(sdf_net, quantized_sdf_net, get_fixed_latent_codes(32).cpu(), voxel_resolution=64))
+
+if 'tiling' in sys.argv:
+    sdf_net = SDFNet()
+    sdf_net.filename = 'hybrid_gan_generator.to'
+    sdf_net.load()
+    sdf_net.eval()
+
+    report = get_tiling_report(sdf_net, get_fixed_latent_codes(2))
+    print_report(report)
+    if any(value != 0 for value in report.values()):
+        print('The images depend on the tile size.')
+        sys.exit(1)
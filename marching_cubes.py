@@ -0,0 +1,177 @@
+import torch
+import numpy as np
+
+# Vectorized marching cubes in torch.
+# Runs on the device of the voxel tensor and processes a batch of volumes at once.
+# The output follows the conventions of skimage.measure.marching_cubes_lewiner:
+# vertices are in index space multiplied by spacing, faces are wound counter-clockwise
+# when seen from the outside (values above the level) and normals point towards lower values.
+
+# Corner c of a cube is offset by (c & 1, (c >> 1) & 1, (c >> 2) & 1) from the cube origin.
+CORNER_OFFSETS = np.array([[c & 1, (c >> 1) & 1, (c >> 2) & 1] for c in range(8)])
+
+# Each edge connects two corners that differ along exactly one axis
+EDGES = [(a, b) for a in range(8) for b in range(a + 1, 8) if bin(a ^ b).count('1') == 1]
+EDGE_AXES = np.array([(a ^ b).bit_length() - 1 for a, b in EDGES])
+EDGE_START_OFFSETS = CORNER_OFFSETS[[a for a, _ in EDGES]]
+
+
+def _get_face_corner_cycles():
+    cycles = []
+    for axis in range(3):
+        u, w = [a for a in range(3) if a != axis]
+        for side in (0, 1):
+            cycle = []
+            for du, dw in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                cycle.append((side << axis) | (du << u) | (dw << w))
+            cycles.append(cycle)
+    return cycles
+
+
+def _get_polygons(configuration):
+    inside = [(configuration >> c) & 1 == 1 for c in range(8)]
+    edge_indices = {edge: i for i, edge in enumerate(EDGES)}
+    get_edge = lambda a, b: edge_indices[(min(a, b), max(a, b))]
+
+    # Collect the iso line segments on each face of the cube.
+    # Ambiguous faces are resolved by separating the inside corners, which is consistent for both cubes sharing a face.
+    neighbors = {}
+    for cycle in _get_face_corner_cycles():
+        face_edges = [get_edge(cycle[i], cycle[(i + 1) % 4]) for i in range(4)]
+        crossings = [face_edges[i] for i in range(4) if inside[cycle[i]] != inside[cycle[(i + 1) % 4]]]
+        if len(crossings) == 2:
+            segments = [crossings]
+        elif len(crossings) == 4:
+            first = 0 if inside[cycle[0]] else 1
+            segments = [[face_edges[first - 1], face_edges[first]], [face_edges[first + 1], face_edges[first + 2]]]
+        else:
+            segments = []
+        for a, b in segments:
+            neighbors.setdefault(a, []).append(b)
+            neighbors.setdefault(b, []).append(a)
+
+    # Every crossed edge lies on two faces, so the segments form closed loops
+    polygons = []
+    remaining = set(neighbors.keys())
+    while len(remaining) > 0:
+        start = min(remaining)
+        polygon = [start]
+        previous, current = None, start
+        while True:
+            remaining.discard(current)
+            candidates = [edge for edge in neighbors[current] if edge != previous]
+            previous, current = current, candidates[0]
+            if current == start:
+                break
+            polygon.append(current)
+
+        # Orient the polygon so that its normal points from the inside corners to the outside corners
+        positions = [CORNER_OFFSETS[EDGES[edge][0]] + CORNER_OFFSETS[EDGES[edge][1]] for edge in polygon]
+        normal = sum(np.cross(positions[i], positions[(i + 1) % len(positions)]) for i in range(len(positions)))
+        outward = sum((CORNER_OFFSETS[b] - CORNER_OFFSETS[a]) * (1 if inside[a] else -1) for a, b in (EDGES[edge] for edge in polygon))
+        if np.dot(normal, outward) < 0:
+            polygon.reverse()
+        polygons.append(polygon)
+    return polygons
+
+
+def _create_triangle_table():
+    table = np.full((256, 5, 3), -1, dtype=np.int64)
+    counts = np.zeros(256, dtype=np.int64)
+    for configuration in range(256):
+        triangles = []
+        for polygon in _get_polygons(configuration):
+            for i in range(1, len(polygon) - 1):
+                triangles.append((polygon[0], polygon[i], polygon[i + 1]))
+        counts[configuration] = len(triangles)
+        if len(triangles) > 0:
+            table[configuration, :len(triangles), :] = triangles
+    return table, counts
+
+
+TRIANGLE_TABLE, TRIANGLE_COUNTS = _create_triangle_table()
+
+
+def _get_gradients(values, indices, coordinates, strides, shape, spacing):
+    # Central differences at the given voxels, one-sided at the border of the volume
+    gradients = []
+    for axis in range(3):
+        has_upper = coordinates[:, axis] < shape[axis] - 1
+        has_lower = coordinates[:, axis] > 0
+        upper = indices + has_upper * strides[axis]
+        lower = indices - has_lower * strides[axis]
+        distance = (has_upper.to(values.dtype) + has_lower.to(values.dtype)) * spacing[axis]
+        gradients.append((values[upper] - values[lower]) / distance)
+    return torch.stack(gradients, dim=1)
+
+
+def marching_cubes(voxels, level=0, spacing=(1.0, 1.0, 1.0)):
+    ''' Takes a tensor of shape (x, y, z) or (batch, x, y, z) on any device.
+    Returns a tuple (vertices, faces, normals) of tensors on the same device,
+    or a list of such tuples if a batch was given. Empty surfaces have zero faces. '''
+    voxels = torch.as_tensor(voxels)
+    is_batch = len(voxels.shape) == 4
+    if not is_batch:
+        voxels = voxels.unsqueeze(0)
+    device = voxels.device
+    batch_size, size_x, size_y, size_z = voxels.shape
+    shape = (size_x, size_y, size_z)
+    strides = (size_y * size_z, size_z, 1)
+    values = voxels.reshape(-1)
+
+    # Cubes are identified by the flat index of their first corner
+    inside = (voxels < level).to(torch.uint8)
+    configurations = torch.zeros(voxels.shape, dtype=torch.uint8, device=device)
+    cube_configurations = configurations[:, :-1, :-1, :-1]
+    for corner, (dx, dy, dz) in enumerate(CORNER_OFFSETS):
+        cube_configurations |= inside[:, dx:size_x - 1 + dx, dy:size_y - 1 + dy, dz:size_z - 1 + dz] << corner
+    configurations = configurations.reshape(-1)
+    cubes = ((configurations != 0) & (configurations != 255)).nonzero().squeeze(1)
+    configurations = configurations[cubes].to(torch.int64)
+
+    triangle_counts = torch.tensor(TRIANGLE_COUNTS, device=device)[configurations]
+    triangle_cubes = torch.repeat_interleave(torch.arange(cubes.shape[0], device=device), triangle_counts)
+    triangle_slots = torch.arange(triangle_cubes.shape[0], device=device) - (torch.cumsum(triangle_counts, dim=0) - triangle_counts)[triangle_cubes]
+    triangle_edges = torch.tensor(TRIANGLE_TABLE, device=device)[configurations[triangle_cubes], triangle_slots, :]
+
+    # Identify each grid edge by the flat index of its start voxel and its axis so that neighboring cubes share vertices
+    edge_start_offsets = torch.tensor(EDGE_START_OFFSETS @ np.array(strides), device=device)
+    edge_axes = torch.tensor(EDGE_AXES, device=device)
+    keys = (cubes[triangle_cubes].unsqueeze(1) + edge_start_offsets[triangle_edges]) * 3 + edge_axes[triangle_edges]
+    edge_used = torch.zeros(values.shape[0] * 3, dtype=torch.bool, device=device)
+    edge_used[keys] = True
+    vertex_ids = torch.cumsum(edge_used, dim=0) - 1
+    faces = vertex_ids[keys]
+    keys = edge_used.nonzero().squeeze(1)
+
+    axes = keys % 3
+    start = keys // 3
+    end = start + torch.tensor(strides, device=device)[axes]
+    coordinates = torch.stack([(start // strides[axis]) % shape[axis] for axis in range(3)], dim=1)
+    vertex_batch = start // (size_x * size_y * size_z)
+
+    start_values = values[start]
+    t = ((level - start_values) / (values[end] - start_values)).unsqueeze(1)
+    spacing = tuple(float(value) for value in spacing)
+    vertices = coordinates.to(values.dtype)
+    vertices += torch.nn.functional.one_hot(axes, 3) * t
+    vertices *= torch.tensor(spacing, dtype=values.dtype, device=device)
+
+    start_gradients = _get_gradients(values, start, coordinates, strides, shape, spacing)
+    end_coordinates = coordinates + torch.nn.functional.one_hot(axes, 3)
+    end_gradients = _get_gradients(values, end, end_coordinates, strides, shape, spacing)
+    normals = -(start_gradients + t * (end_gradients - start_gradients))
+    normals /= torch.norm(normals, dim=1, keepdim=True).clamp(min=1e-12)
+
+    vertex_counts = torch.bincount(vertex_batch, minlength=batch_size)
+    face_batch = cubes[triangle_cubes] // (size_x * size_y * size_z)
+    face_counts = torch.bincount(face_batch, minlength=batch_size)
+    faces -= (torch.cumsum(vertex_counts, dim=0) - vertex_counts)[face_batch].unsqueeze(1)
+
+    vertex_counts = vertex_counts.tolist()
+    face_counts = face_counts.tolist()
+    result = list(zip(torch.split(vertices, vertex_counts), torch.split(faces, face_counts), torch.split(normals, vertex_counts)))
+    if is_batch:
+        return result
+    else:
+        return result[0]
@@ -1,47 +1,119 @@
 from model.sdf_net import SDFNet, LATENT_CODE_SIZE
 import numpy as np
-from util import device, standard_normal_distribution
+from util import device, standard_normal_distribution, sample_surface_points
 from tqdm import tqdm
 import sys
+import os
 import torch
-import skimage.measure
-import trimesh
+import torch.nn.functional as F
+import multiprocessing
+from marching_cubes import marching_cubes
 
 LEVEL = 0
 
+# Shapes per network batch when sampling point clouds from a SDFNet
+SHAPES_PER_BATCH = 16
+
 def rescale_point_cloud(point_cloud, method=None):
     if method == 'half_unit_sphere':
         point_cloud /= np.linalg.norm(point_cloud, axis=1).max() * 2
     elif method == 'half_unit_cube':
         point_cloud /= np.abs(point_cloud).max() * 2
 
-def sample_point_clouds(sdf_net, sample_count, point_cloud_size, voxel_resolution=128, rescale='half_unit_sphere', latent_codes=None):
-    result = np.zeros((sample_count, point_cloud_size, 3))
-    if latent_codes is None:
-        latent_codes = standard_normal_distribution.sample((sample_count, LATENT_CODE_SIZE)).to(device)
-    for i in tqdm(range(sample_count)):
-        try:
-            point_cloud = sdf_net.get_uniform_surface_points(latent_codes[i, :], point_count=point_cloud_size, voxel_resolution=voxel_resolution, sphere_only=False, level=LEVEL)
-            rescale_point_cloud(point_cloud, method=rescale)
-            result[i, :, :] = point_cloud
-        except AttributeError:
+def _initialize_worker():
+    # Each worker uses one thread, the parallelism comes from the number of processes
+    torch.set_num_threads(1)
+
+def create_worker_pool(worker_count=None):
+    # The workers are forked, since this script runs its commands at import time and spawned workers would run them again.
+    # They only receive numpy arrays, so forking is safe even if the parent process uses CUDA.
+    if worker_count is None:
+        worker_count = os.cpu_count()
+    return multiprocessing.get_context('fork').Pool(worker_count, initializer=_initialize_worker)
+
+def _sample_volume(voxels, voxel_resolution, level, point_count, rescale, seed):
+    # Runs marching cubes on one volume with the conventions of SDFNet.get_mesh and samples points uniformly on the surface.
+    # Returns None if the surface is empty.
+    size = 2
+    voxels = F.pad(torch.as_tensor(voxels), (1, 1, 1, 1, 1, 1), mode='constant', value=1)
+    vertices, faces, _ = marching_cubes(voxels, level=level, spacing=(size / voxel_resolution, size / voxel_resolution, size / voxel_resolution))
+    if faces.shape[0] == 0:
+        return None
+    generator = torch.Generator().manual_seed(seed)
+    point_cloud = sample_surface_points(vertices.to(torch.float64) - size / 2, faces, point_count, generator=generator).numpy()
+    rescale_point_cloud(point_cloud, method=rescale)
+    return point_cloud
+
+def _limit_pending(results, max_pending):
+    # Waits until at most max_pending of the results are unfinished, so that the queued volumes don't pile up in memory
+    # when the network or the caller runs ahead of the workers. Assumes that the results finish roughly in order.
+    if max_pending is None:
+        max_pending = 2 * os.cpu_count()
+    if len(results) >= max_pending:
+        results[-max_pending].wait()
+
+def _get_seed(seed):
+    # Without a seed, the result depends on the global torch random state like the rest of the sampling
+    if seed is None:
+        return torch.randint(2**31, (1,)).item()
+    return seed
+
+def collect_point_clouds(results, point_cloud_size):
+    result = np.zeros((len(results), point_cloud_size, 3))
+    for i, async_result in enumerate(tqdm(results)):
+        point_cloud = async_result.get()
+        if point_cloud is None:
             print("Warning: Empty mesh.")
+        else:
+            result[i, :, :] = point_cloud
     return result
 
-def sample_from_voxels(voxels, point_cloud_size, rescale='half_unit_sphere'):
-    result = np.zeros((voxels.shape[0], point_cloud_size, 3))
-    size = 2
+def submit_point_cloud_sampling(pool, sdf_net, sample_count, point_cloud_size, voxel_resolution=128, rescale='half_unit_sphere', latent_codes=None, seed=None, max_pending=None):
+    # Evaluates the network for several shapes at once and queues marching cubes and surface sampling in the worker pool.
+    # Returns a list of pending results that can be passed to collect_point_clouds.
+    # Point cloud i is sampled with seed + i, so the result only depends on the seed and the latent codes, not on the number of workers.
+    # At most max_pending volumes (default: twice the number of CPUs) are queued at a time, the call blocks until the workers catch up.
+    seed = _get_seed(seed)
+    if latent_codes is None:
+        generator = torch.Generator().manual_seed(seed)
+        latent_codes = torch.randn((sample_count, LATENT_CODE_SIZE), generator=generator).to(device)
+
+    results = []
+    for batch_start in range(0, sample_count, SHAPES_PER_BATCH):
+        batch_end = min(batch_start + SHAPES_PER_BATCH, sample_count)
+        voxels = sdf_net.get_voxels(latent_codes[batch_start:batch_end, :], voxel_resolution, sphere_only=False, level=LEVEL)
+        for i in range(batch_end - batch_start):
+            _limit_pending(results, max_pending)
+            results.append(pool.apply_async(_sample_volume, args=(voxels[i, :, :, :], voxel_resolution, LEVEL, point_cloud_size, rescale, seed + batch_start + i)))
+    return results
+
+def sample_point_clouds(sdf_net, sample_count, point_cloud_size, voxel_resolution=128, rescale='half_unit_sphere', latent_codes=None, seed=None, pool=None):
+    own_pool = pool is None
+    if own_pool:
+        pool = create_worker_pool()
+    results = submit_point_cloud_sampling(pool, sdf_net, sample_count, point_cloud_size, voxel_resolution=voxel_resolution, rescale=rescale, latent_codes=latent_codes, seed=seed)
+    result = collect_point_clouds(results, point_cloud_size)
+    if own_pool:
+        pool.close()
+        pool.join()
+    return result
+
+def sample_from_voxels(voxels, point_cloud_size, rescale='half_unit_sphere', seed=None, pool=None):
+    seed = _get_seed(seed)
+    voxels = np.asarray(voxels)
     voxel_resolution = voxels.shape[1]
-    for i in tqdm(range(voxels.shape[0])):
-        voxels_current = voxels[i, :, :, :]
-        voxels_current = np.pad(voxels_current, 1, mode='constant', constant_values=1)
-        
-        vertices, faces, normals, _ = skimage.measure.marching_cubes_lewiner(voxels_current, level=0, spacing=(size / voxel_resolution, size / voxel_resolution, size / voxel_resolution))
-        vertices -= size / 2
-        mesh = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_normals=normals)
-        point_cloud = mesh.sample(point_cloud_size)
-        rescale_point_cloud(point_cloud, method=rescale)
-        result[i, :, :] = point_cloud
+
+    own_pool = pool is None
+    if own_pool:
+        pool = create_worker_pool()
+    results = []
+    for i in range(voxels.shape[0]):
+        _limit_pending(results, None)
+        results.append(pool.apply_async(_sample_volume, args=(voxels[i, :, :, :], voxel_resolution, 0, point_cloud_size, rescale, seed + i)))
+    result = collect_point_clouds(results, point_cloud_size)
+    if own_pool:
+        pool.close()
+        pool.join()
     return result
 
 
@@ -56,19 +128,28 @@ if 'sample' in sys.argv:
 
 if 'checkpoints' in sys.argv:
     import glob
-    from tqdm import tqdm
     torch.manual_seed(1234)
-    files = glob.glob('models/checkpoints/hybrid_progressive_gan_generator_2-epoch-*.to', recursive=True)
+    files = sorted(glob.glob('models/checkpoints/hybrid_progressive_gan_generator_2-epoch-*.to', recursive=True))
     latent_codes = standard_normal_distribution.sample((50, LATENT_CODE_SIZE)).to(device)
-    for filename in tqdm(files):
-        epoch_id = filename[61:-3]
-        sdf_net = SDFNet()
-        sdf_net.filename = filename[7:]
-        sdf_net.load()
-        sdf_net.eval()
-
-        clouds = sample_point_clouds(sdf_net, 50, 2048, voxel_resolution=64, latent_codes=latent_codes)
-        np.save('data/chairs/results/voxels_{:s}.npy'.format(epoch_id), clouds)
+    # The point clouds of a checkpoint are collected after the network has evaluated the next checkpoint,
+    # so that the workers are busy while the network runs.
+    pool = create_worker_pool()
+    pending = None
+    for filename in tqdm(files + [None]):
+        if filename is not None:
+            sdf_net = SDFNet()
+            sdf_net.filename = filename[7:]
+            sdf_net.load()
+            sdf_net.eval()
+            results = submit_point_cloud_sampling(pool, sdf_net, 50, 2048, voxel_resolution=64, latent_codes=latent_codes, seed=1234)
+
+        if pending is not None:
+            epoch_id, pending_results = pending
+            clouds = collect_point_clouds(pending_results, 2048)
+            np.save('data/chairs/results/voxels_{:s}.npy'.format(epoch_id), clouds)
+        pending = (filename[61:-3], results) if filename is not None else None
+    pool.close()
+    pool.join()
 
 
 if 'dataset' in sys.argv:
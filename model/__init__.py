@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import Sequential, Linear, ReLU, BatchNorm1d
+import torch.ao.nn.quantized.dynamic as quantized_dynamic
 
 import os
 
@@ -9,6 +10,14 @@ CHECKPOINT_PATH = os.path.join(MODEL_PATH, 'checkpoints')
 LATENT_CODES_FILENAME = os.path.join(MODEL_PATH, "sdf_net_latent_codes.to")
 LATENT_CODE_SIZE = 128
 
+# Linear layers, including the int8 layers of model.quantization.quantize, which are no nn.Linear
+LINEAR_LAYERS = (nn.Linear, quantized_dynamic.Linear)
+
+def get_linear_weight(layer):
+    # The weight of a quantized layer is a method that returns the int8 weight, gradients are propagated through its dequantized value
+    weight = layer.weight
+    return weight().dequantize() if callable(weight) else weight
+
 class Lambda(nn.Module):
     def __init__(self, function):
         super(Lambda, self).__init__()
@@ -1,6 +1,7 @@
 import torch
 from torch.nn import Linear, Sequential, ReLU, LayerNorm
 import torch.nn.functional as F
+from model import get_linear_weight
 
 try:
     from torch_scatter import scatter_max
@@ -83,6 +84,10 @@ class SDFGenerator(torch.nn.Module):
         self.z_lin1 = Linear(latent_channels, hidden_channels)
         self.z_lin2 = Linear(latent_channels, hidden_channels)
 
+        # Data type for the hidden layers in eval mode, e.g. torch.bfloat16 or torch.float16. None means float32.
+        # The input layer, which sees the raw point coordinates, and the output layer always run in float32.
+        self.inference_dtype = None
+
     def forward(self, pos, z):
         # pos: [batch_size, num_points, 3]
         # z: [batch_size, latent_channels]
@@ -98,12 +103,19 @@ class SDFGenerator(torch.nn.Module):
 
         assert pos.size(0) == z.size(0)
 
+        reduced_precision = self.inference_dtype is not None and not self.training
+        autocast = torch.autocast(device_type=pos.device.type, dtype=self.inference_dtype if reduced_precision else torch.bfloat16, enabled=reduced_precision)
+
         x = pos
         for i, (lin, norm) in enumerate(zip(self.lins, self.norms)):
             if i == self.num_layers // 2:
                 x = torch.cat([x, pos], dim=-1)
 
-            x = lin(x)
+            if i == 0 or i == self.num_layers - 1:
+                x = lin(x.float())
+            else:
+                with autocast:
+                    x = lin(x)
 
             if i == 0:
                 x = self.z_lin1(z).unsqueeze(1) + x
@@ -117,3 +129,41 @@ class SDFGenerator(torch.nn.Module):
                 x = F.dropout(x, p=self.dropout, training=self.training)
 
         return x
+
+    def evaluate_with_gradients(self, pos, z):
+        # Returns the output of forward together with its gradient with respect to pos, shape [batch_size, num_points, 3].
+        # The Jacobian is propagated through the layers alongside the activations, without building an autograd graph.
+        with torch.no_grad():
+            pos = pos.unsqueeze(0) if pos.dim() == 2 else pos
+            z = z.unsqueeze(0) if z.dim() == 1 else z
+            identity = torch.eye(3, device=pos.device, dtype=pos.dtype)
+
+            x = pos
+            jacobian = identity.expand(pos.shape[:-1] + (3, 3))
+            for i, (lin, norm) in enumerate(zip(self.lins, self.norms)):
+                if i == self.num_layers // 2:
+                    x = torch.cat([x, pos], dim=-1)
+                    jacobian = torch.cat([jacobian, identity.expand(pos.shape[:-1] + (3, 3))], dim=-1)
+
+                x = lin(x)
+                jacobian = torch.matmul(jacobian, get_linear_weight(lin).t())
+
+                if i == 0:
+                    x = self.z_lin1(z).unsqueeze(1) + x
+
+                if i == self.num_layers // 2:
+                    x = self.z_lin2(z).unsqueeze(1) + x
+
+                if i < self.num_layers - 1:
+                    if self.norm:
+                        mean = x.mean(dim=-1, keepdim=True)
+                        std = torch.sqrt(x.var(dim=-1, unbiased=False, keepdim=True) + norm.eps)
+                        normalized = (x - mean) / std
+                        jacobian = (jacobian - jacobian.mean(dim=-1, keepdim=True)
+                            - normalized.unsqueeze(-2) * (jacobian * normalized.unsqueeze(-2)).mean(dim=-1, keepdim=True)) / std.unsqueeze(-2)
+                        jacobian = jacobian * norm.weight
+                        x = normalized * norm.weight + norm.bias
+                    jacobian = jacobian * (x > 0).unsqueeze(-2)
+                    x = F.relu(x)
+
+        return x, jacobian.squeeze(-1)
@@ -0,0 +1,53 @@
+import torch
+from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+from model.sdf_net import SDFNet
+from util import evaluate_on_grid
+
+# Int8 dynamic quantization of the SDF networks for inference on the CPU.
+# The weights of the hidden layers are stored as int8 and the activations are quantized on the fly.
+# The layers that see the point coordinates and the output layer stay in float32, as with inference_dtype.
+#
+# Calibration evaluates the network for sample latent codes on a grid and adds the hidden layers one by one,
+# skipping layers whose quantization would increase the SDF error close to the surface beyond the tolerance.
+
+CALIBRATION_VOXEL_RESOLUTION = 32
+
+def get_quantizable_layers(model):
+    if isinstance(model, SDFNet):
+        # The input layers are used through slices of their weights in forward_with_latent_biases, so they can't be replaced
+        return ['layers1.{:d}'.format(i) for i in range(2, len(model.layers1), 2)] \
+            + ['layers2.{:d}'.format(i) for i in range(2, len(model.layers2) - 2, 2)]
+    else:
+        # SDFGenerator
+        return ['lins.{:d}'.format(i) for i in range(1, model.num_layers - 1)]
+
+def _quantize_layers(model, layer_names):
+    quantized_model = quantize_dynamic(model, {name: per_channel_dynamic_qconfig for name in layer_names}, dtype=torch.qint8)
+    quantized_model.eval()
+    return quantized_model
+
+def quantize(model, calibration_latent_codes, tolerance=0.01, level=0, voxel_resolution=CALIBRATION_VOXEL_RESOLUTION):
+    ''' Returns a quantized copy of a SDFNet or SDFGenerator on the CPU.
+    The copy has the same class and interface as the original model.
+    Its quantized_layers attribute lists the layers that were quantized. '''
+    if next(model.parameters()).device.type != 'cpu':
+        raise ValueError('Dynamic quantization is only supported for models on the CPU.')
+    model.eval()
+    calibration_latent_codes = calibration_latent_codes.cpu()
+
+    reference = evaluate_on_grid(model, calibration_latent_codes, voxel_resolution)
+    near_surface = torch.abs(reference - level) < 2 * 2 / (voxel_resolution - 1)
+    if not near_surface.any():
+        raise ValueError('The calibration latent codes result in empty surfaces.')
+
+    quantized_layers = []
+    for layer_name in get_quantizable_layers(model):
+        candidate = _quantize_layers(model, quantized_layers + [layer_name])
+        values = evaluate_on_grid(candidate, calibration_latent_codes, voxel_resolution)
+        error = torch.abs(values - reference)[near_surface].max().item()
+        if error <= tolerance:
+            quantized_layers.append(layer_name)
+
+    quantized_model = _quantize_layers(model, quantized_layers)
+    quantized_model.quantized_layers = quantized_layers
+    return quantized_model
@@ -0,0 +1,111 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# Memoizes the results of SDFNet.get_voxels and SDFNet.get_mesh.
+# Entries are dicts of numpy arrays, kept in an LRU that is bounded by its size in bytes.
+# If a directory is given, entries are also written to disk as compressed npz files, where they outlive both eviction
+# from memory and the process. The files are bounded by max_disk_bytes, the least recently used ones are deleted first.
+# Their modification time records when they were last used, so several processes can share the directory.
+
+class SDFCache():
+    def __init__(self, max_bytes=1024**3, directory=None, max_disk_bytes=4 * 1024**3):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._evict_files()
+
+    def get_key(self, parameter_fingerprint, kind, latent_code, *arguments):
+        latent_code_bytes = latent_code.detach().to(torch.float32).cpu().numpy().tobytes()
+        key = hashlib.sha1()
+        key.update(parameter_fingerprint.encode())
+        key.update(kind.encode())
+        key.update(latent_code_bytes)
+        key.update(repr(arguments).encode())
+        return key.hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return {name: array.copy() for name, array in self.entries[key].items()}
+
+        if self.directory is not None and os.path.isfile(self._get_filename(key)):
+            with np.load(self._get_filename(key)) as data:
+                entry = {name: data[name] for name in data.files}
+            os.utime(self._get_filename(key))
+            self._insert(key, entry)
+            self.hits += 1
+            return {name: array.copy() for name, array in entry.items()}
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        entry = {name: np.array(array, copy=True) for name, array in entry.items()}
+        if key in self.entries:
+            self.size -= self._get_size(self.entries.pop(key))
+        self._insert(key, entry)
+        if self.directory is not None:
+            self._write(key, entry)
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.size += self._get_size(entry)
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            evicted_key, evicted_entry = self.entries.popitem(last=False)
+            self.size -= self._get_size(evicted_entry)
+
+    def _write(self, key, entry):
+        filename = self._get_filename(key)
+        if os.path.isfile(filename):
+            return
+        # Write to a temporary file first so that an interrupted write never leaves a corrupt entry
+        temporary_filename = filename + '.tmp.npz'
+        np.savez_compressed(temporary_filename, **entry)
+        os.replace(temporary_filename, filename)
+        # The directory is only scanned when the files may exceed the limit
+        self.disk_size += os.path.getsize(filename)
+        if self.disk_size > self.max_disk_bytes:
+            self._evict_files()
+
+    def _evict_files(self):
+        filenames = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz') and not name.endswith('.tmp.npz')]
+        files = []
+        for filename in filenames:
+            try:
+                files.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+            except FileNotFoundError:
+                # Deleted by another process
+                pass
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, filename in sorted(files):
+            if size <= self.max_disk_bytes:
+                break
+            size -= file_size
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        self.disk_size = size
+
+    def _get_size(self, entry):
+        return sum(array.nbytes for array in entry.values())
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
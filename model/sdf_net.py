@@ -1,8 +1,12 @@
 from model import *
+import torch.nn.functional as F
 import trimesh
-import skimage.measure
+from marching_cubes import marching_cubes
 from util import get_points_in_unit_sphere, get_voxel_coordinates
 import numpy as np
+import math
+import hashlib
+from model.sdf_cache import SDFCache
 
 class SDFVoxelizationHelperData():
     def __init__(self, device, voxel_resolution, sphere_only=True):
@@ -12,103 +16,401 @@ class SDFVoxelizationHelperData():
             unit_sphere_mask = np.linalg.norm(sample_points, axis=1) < 1.1
             sample_points = sample_points[unit_sphere_mask, :]
             self.unit_sphere_mask = unit_sphere_mask.reshape(voxel_resolution, voxel_resolution, voxel_resolution)
+            self.unit_sphere_mask_tensor = torch.tensor(self.unit_sphere_mask, device=device)
         
         self.sample_points = torch.tensor(sample_points, device=device)
         self.point_count = self.sample_points.shape[0]
 
 sdf_voxelization_helper = dict()
 
+def get_meshes_from_voxels(voxels, voxel_resolution, level=0):
+    # Takes volumes of shape (n, x, y, z) as returned by SDFNet.get_voxels for n latent codes, as a tensor or numpy array.
+    # Returns one mesh per volume in the coordinates used by SDFNet.get_mesh, or None for empty surfaces.
+    size = 2
+    voxels = F.pad(torch.as_tensor(voxels), (1, 1, 1, 1, 1, 1), mode='constant', value=1)
+    meshes = []
+    for vertices, faces, normals in marching_cubes(voxels, level=level, spacing=(size / voxel_resolution, size / voxel_resolution, size / voxel_resolution)):
+        if faces.shape[0] == 0:
+            meshes.append(None)
+            continue
+        vertices = vertices.cpu().numpy() - size / 2
+        meshes.append(trimesh.Trimesh(vertices=vertices, faces=faces.cpu().numpy(), vertex_normals=normals.cpu().numpy()))
+    return meshes
+
 SDF_NET_BREADTH = 256
+# Number of linear layers, half of them before and half after the skip connection
+SDF_NET_DEPTH = 8
+
+# Adaptive voxelization starts with blocks of this many voxels per axis (must be a power of two)
+ADAPTIVE_VOXELIZATION_BLOCK_SIZE = 8
+# Safety factor for the narrow band, since the network is not exactly 1-Lipschitz
+ADAPTIVE_VOXELIZATION_MARGIN = 1.5
 
 class SDFNet(SavableModule):
-    def __init__(self, latent_code_size=LATENT_CODE_SIZE, device='cuda'):
+    def __init__(self, latent_code_size=LATENT_CODE_SIZE, device='cuda', breadth=SDF_NET_BREADTH, depth=SDF_NET_DEPTH):
         super(SDFNet, self).__init__(filename="sdf_net.to")
-        self.layers1 = nn.Sequential(
-            nn.Linear(in_features = 3 + latent_code_size, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+        self.latent_code_size = latent_code_size
+        self._create_layers(breadth, depth)
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+        # In inference, precompute the contribution of the latent code to the two input layers once per shape
+        # instead of concatenating it to every point
+        self.use_latent_folding = True
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+        # Data type for the hidden layers in eval mode, e.g. torch.bfloat16 or torch.float16. None means float32.
+        # The point inputs, the output layer and the Tanh always run in float32, so the returned SDF values
+        # and all decisions about the surface are made in full precision.
+        self.inference_dtype = None
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True)
-        )
+        # Optional cache for get_voxels and get_mesh, see enable_cache
+        self.cache = None
+        self._fingerprint_state = None
+        self._fingerprint = None
 
-        self.layers2 = nn.Sequential(
-            nn.Linear(in_features = SDF_NET_BREADTH + latent_code_size + 3, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+        self.to(device)
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+    def _create_layers(self, breadth, depth):
+        # Smaller networks, such as distilled students, use the same layout with a different breadth and depth
+        if depth % 2 != 0 or depth < 4:
+            raise ValueError('The depth of the SDFNet must be an even number of at least 4.')
+        self.breadth = breadth
+        self.depth = depth
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = SDF_NET_BREADTH),
-            nn.ReLU(inplace=True),
+        layers1 = [nn.Linear(in_features = 3 + self.latent_code_size, out_features = breadth), nn.ReLU(inplace=True)]
+        for _ in range(depth // 2 - 1):
+            layers1 += [nn.Linear(in_features = breadth, out_features = breadth), nn.ReLU(inplace=True)]
+        self.layers1 = nn.Sequential(*layers1)
 
-            nn.Linear(in_features = SDF_NET_BREADTH, out_features = 1),
-            nn.Tanh()
-        )
+        layers2 = [nn.Linear(in_features = breadth + self.latent_code_size + 3, out_features = breadth), nn.ReLU(inplace=True)]
+        for _ in range(depth // 2 - 2):
+            layers2 += [nn.Linear(in_features = breadth, out_features = breadth), nn.ReLU(inplace=True)]
+        layers2 += [nn.Linear(in_features = breadth, out_features = 1), nn.Tanh()]
+        self.layers2 = nn.Sequential(*layers2)
 
-        self.to(device)
+    def load(self, epoch=None):
+        self.load_parameters(torch.load(self.get_filename(epoch=epoch), map_location=self.device))
+
+    def load_parameters(self, state_dict):
+        # The breadth and depth are taken from the state dict, so that smaller networks can be loaded
+        # into an SDFNet that was created with the default architecture.
+        breadth = state_dict['layers1.0.weight'].shape[0]
+        depth = len([key for key in state_dict.keys() if key.endswith('.weight')])
+        if breadth != self.breadth or depth != self.depth:
+            device = self.device
+            self._create_layers(breadth, depth)
+            self.to(device)
+        self.load_state_dict(state_dict, strict=False)
+
+    def enable_cache(self, max_bytes=1024**3, directory=None, max_disk_bytes=4 * 1024**3):
+        self.cache = SDFCache(max_bytes=max_bytes, directory=directory, max_disk_bytes=max_disk_bytes)
+
+    def get_parameter_fingerprint(self):
+        # Every in-place change of a parameter (load_state_dict, optimizer steps) increments its version counter,
+        # so the parameters only need to be hashed again after they changed.
+        # The version counter is private, without it the parameters are hashed on every call.
+        parameters = list(self.parameters())
+        if all(hasattr(parameter, '_version') for parameter in parameters):
+            state = tuple((parameter.data_ptr(), parameter._version) for parameter in parameters)
+        else:
+            state = None
+        if state is None or state != self._fingerprint_state:
+            fingerprint = hashlib.sha1()
+            # The module structure is included so that modified copies, such as quantized ones, don't share cache entries
+            fingerprint.update(repr(self).encode())
+            for parameter in self.parameters():
+                fingerprint.update(parameter.detach().cpu().numpy().tobytes())
+            self._fingerprint = fingerprint.hexdigest()
+            self._fingerprint_state = state
+        return self._fingerprint
 
     def forward(self, points, latent_codes):
+        # Points of shape (batch size, point count, 3) with one latent code of shape (batch size, latent_code_size) per shape
+        # are evaluated without repeating the latent codes, returning (batch size, point count).
+        # A grid shared by all shapes can be passed as grid_points.expand(batch_size, -1, -1).
+        if len(points.shape) == 3:
+            bias1, bias2 = self.get_latent_biases(latent_codes)
+            return self.forward_with_latent_biases(points, (bias1.unsqueeze(1), bias2.unsqueeze(1)))
+
         input = torch.cat((points, latent_codes), dim=1)
-        x = self.layers1(input)
-        x = torch.cat((x, input), dim=1)
-        x = self.layers2(x)
+        with self._get_inference_autocast(input.device):
+            x = self.layers1(input)
+            x = torch.cat((x, input), dim=1)
+            x = self.layers2[:-2](x)
+        x = self.layers2[-2:](x.float())
         return x.squeeze()
 
+    def _get_inference_autocast(self, device):
+        enabled = self.inference_dtype is not None and not self.training
+        return torch.autocast(device_type=device.type, dtype=self.inference_dtype if enabled else torch.bfloat16, enabled=enabled)
+
+    def get_latent_biases(self, latent_codes):
+        # The latent code columns of the two input layers, folded into their biases.
+        # latent_codes can be a single code or a stack of codes.
+        input_layer1 = self.layers1[0]
+        input_layer2 = self.layers2[0]
+        breadth = input_layer1.out_features
+        bias1 = F.linear(latent_codes, input_layer1.weight[:, 3:], input_layer1.bias)
+        bias2 = F.linear(latent_codes, input_layer2.weight[:, breadth + 3:], input_layer2.bias)
+        return bias1, bias2
+
+    def forward_with_latent_biases(self, points, latent_biases):
+        # Gives the same result as forward, but takes the output of get_latent_biases instead of per point latent codes.
+        # With biases of shape (n, breadth) and points of shape (m, 3) or (n, m, 3), the biases must be unsqueezed to (n, 1, breadth) and the result has shape (n, m).
+        bias1, bias2 = latent_biases
+        input_layer1 = self.layers1[0]
+        input_layer2 = self.layers2[0]
+        breadth = input_layer1.out_features
+        x = F.relu(F.linear(points, input_layer1.weight[:, :3]) + bias1)
+        with self._get_inference_autocast(points.device):
+            x = self.layers1[2:](x)
+            x = torch.cat((x, points.expand(x.shape[:-1] + (3,))), dim=-1)
+            x = F.relu(F.linear(x, input_layer2.weight[:, :breadth + 3]) + bias2)
+            x = self.layers2[2:-2](x)
+        x = self.layers2[-2:](x.float())
+        return x.squeeze()
+
+    def evaluate_with_gradients(self, points, latent_code):
+        # Returns the SDF values and their gradients with respect to the points from a single network pass.
+        # The forward pass keeps only the ReLU masks and the Tanh output, and the gradient is propagated back
+        # through the transposed weights by hand, so no autograd graph is built.
+        # This always runs in float32, regardless of inference_dtype, since the gradients are used as normals.
+        with torch.no_grad():
+            bias1, bias2 = self.get_latent_biases(latent_code)
+            input_layer1 = self.layers1[0]
+            input_layer2 = self.layers2[0]
+            breadth = input_layer1.out_features
+
+            x = F.linear(points, input_layer1.weight[:, :3]) + bias1
+            x, masks1 = self._forward_with_masks(self.layers1[1:], x)
+            x = F.linear(torch.cat((x, points), dim=1), input_layer2.weight[:, :breadth + 3]) + bias2
+            x, masks2 = self._forward_with_masks(self.layers2[1:], x)
+
+            gradient = self._backward_with_masks(self.layers2[1:], masks2, torch.ones_like(x))
+            gradient = torch.matmul(gradient, input_layer2.weight[:, :breadth + 3])
+            point_gradients = gradient[:, breadth:]
+            gradient = self._backward_with_masks(self.layers1[1:], masks1, gradient[:, :breadth])
+            point_gradients = point_gradients + torch.matmul(gradient, input_layer1.weight[:, :3])
+        return x.squeeze(1), point_gradients
+
+    def _forward_with_masks(self, layers, x):
+        masks = []
+        for layer in layers:
+            if isinstance(layer, LINEAR_LAYERS):
+                x = layer(x)
+            elif isinstance(layer, nn.ReLU):
+                masks.append(x > 0)
+                x = F.relu(x, inplace=True)
+            elif isinstance(layer, nn.Tanh):
+                x = torch.tanh(x)
+                masks.append(1 - x ** 2)
+            else:
+                raise NotImplementedError('Gradient propagation is not implemented for ' + type(layer).__name__)
+        return x, masks
+
+    def _backward_with_masks(self, layers, masks, gradient):
+        masks = list(masks)
+        for layer in reversed(layers):
+            if isinstance(layer, LINEAR_LAYERS):
+                gradient = torch.matmul(gradient, get_linear_weight(layer))
+            else:
+                gradient.mul_(masks.pop())
+        return gradient
+
+    def evaluate_with_gradients_in_batches(self, points, latent_code, batch_size=100000, shape_indices=None):
+        # If shape_indices is given, latent_code is a stack of latent codes and shape_indices selects the code of each point.
+        sdf = torch.zeros(points.shape[0], device=points.device)
+        gradients = torch.zeros((points.shape[0], 3), device=points.device)
+        for start in range(0, points.shape[0], batch_size):
+            batch_latent_code = latent_code if shape_indices is None else latent_code[shape_indices[start:start + batch_size], :]
+            sdf[start:start + batch_size], gradients[start:start + batch_size, :] = self.evaluate_with_gradients(points[start:start + batch_size, :], batch_latent_code)
+        return sdf, gradients
+
+    def evaluate(self, points, latent_code):
+        if self.use_latent_folding:
+            return self.forward_with_latent_biases(points, self.get_latent_biases(latent_code))
+        else:
+            return self(points, latent_code.repeat(points.shape[0], 1))
+
     def evaluate_in_batches(self, points, latent_code, batch_size=100000, return_cpu_tensor=True):
-        latent_codes = latent_code.repeat(batch_size, 1)
         with torch.no_grad():
+            if self.use_latent_folding:
+                latent_biases = self.get_latent_biases(latent_code)
+                evaluate_batch = lambda batch_points: self.forward_with_latent_biases(batch_points, latent_biases)
+            else:
+                latent_codes = latent_code.repeat(batch_size, 1)
+                evaluate_batch = lambda batch_points: self(batch_points, latent_codes[:batch_points.shape[0], :])
+
             batch_count = points.shape[0] // batch_size
             if return_cpu_tensor:
                 result = torch.zeros((points.shape[0]))
             else:
                 result = torch.zeros((points.shape[0]), device=points.device)
             for i in range(batch_count):
-                result[batch_size * i:batch_size * (i+1)] = self(points[batch_size * i:batch_size * (i+1), :], latent_codes)
-            remainder = points.shape[0] - batch_size * batch_count
-            result[batch_size * batch_count:] = self(points[batch_size * batch_count:, :], latent_codes[:remainder, :])
+                result[batch_size * i:batch_size * (i+1)] = evaluate_batch(points[batch_size * i:batch_size * (i+1), :])
+            if points.shape[0] > batch_size * batch_count:
+                result[batch_size * batch_count:] = evaluate_batch(points[batch_size * batch_count:, :])
+        return result
+
+    def evaluate_shapes_in_batches(self, points, latent_codes, shape_indices, batch_size=100000):
+        # Evaluates points of different shapes in the same batches, shape_indices selects the latent code of each point.
+        # Returns a tensor on the device of the points.
+        if latent_codes.shape[0] == 1:
+            return self.evaluate_in_batches(points, latent_codes[0, :], batch_size=batch_size, return_cpu_tensor=False)
+        with torch.no_grad():
+            if self.use_latent_folding:
+                bias1, bias2 = self.get_latent_biases(latent_codes)
+                evaluate_batch = lambda batch_points, batch_indices: self.forward_with_latent_biases(batch_points, (bias1[batch_indices, :], bias2[batch_indices, :]))
+            else:
+                evaluate_batch = lambda batch_points, batch_indices: self(batch_points, latent_codes[batch_indices, :])
+
+            result = torch.zeros((points.shape[0]), device=points.device)
+            for start in range(0, points.shape[0], batch_size):
+                result[start:start + batch_size] = evaluate_batch(points[start:start + batch_size, :], shape_indices[start:start + batch_size])
+        return result
+
+    def evaluate_multiple_in_batches(self, points, latent_codes, batch_size=100000, return_cpu_tensor=True):
+        # Returns a tensor of shape (latent code count, point count).
+        # Each network call processes up to batch_size (latent code, point) pairs, covering several shapes if the point set is small.
+        shape_count = latent_codes.shape[0]
+        point_count = points.shape[0]
+        if return_cpu_tensor:
+            result = torch.zeros((shape_count, point_count))
+        else:
+            result = torch.zeros((shape_count, point_count), device=points.device)
+
+        points_per_batch = min(point_count, batch_size)
+        shapes_per_batch = max(1, batch_size // point_count)
+        with torch.no_grad():
+            for shape_start in range(0, shape_count, shapes_per_batch):
+                shape_end = min(shape_start + shapes_per_batch, shape_count)
+                current_shape_count = shape_end - shape_start
+                for point_start in range(0, point_count, points_per_batch):
+                    point_end = min(point_start + points_per_batch, point_count)
+                    current_point_count = point_end - point_start
+                    if self.use_latent_folding:
+                        bias1, bias2 = self.get_latent_biases(latent_codes[shape_start:shape_end, :])
+                        sdf = self.forward_with_latent_biases(points[point_start:point_end, :], (bias1.unsqueeze(1), bias2.unsqueeze(1)))
+                    else:
+                        batch_points = points[point_start:point_end, :].repeat(current_shape_count, 1)
+                        batch_latent_codes = latent_codes[shape_start:shape_end, :].repeat_interleave(current_point_count, dim=0)
+                        sdf = self(batch_points, batch_latent_codes)
+                    result[shape_start:shape_end, point_start:point_end] = sdf.reshape(current_shape_count, current_point_count)
         return result
 
-    def get_voxels(self, latent_code, voxel_resolution, sphere_only=True, pad=True):
+    def _get_voxels_adaptive(self, latent_code, voxel_resolution, level=0):
+        # Evaluates the SDF at the centers of coarse blocks and only subdivides blocks that can contain the surface.
+        # Blocks outside the narrow band are filled with the SDF value at their center.
+        grid_spacing = 2.0 / (voxel_resolution - 1)
+        voxels = torch.zeros((voxel_resolution, voxel_resolution, voxel_resolution), device=self.device)
+        block_size = ADAPTIVE_VOXELIZATION_BLOCK_SIZE
+        block_starts = torch.arange(0, voxel_resolution, block_size, device=self.device)
+        origins = torch.stack(torch.meshgrid(block_starts, block_starts, block_starts, indexing='ij'), dim=-1).reshape(-1, 3)
+
+        while True:
+            centers = origins.to(torch.float32) + (block_size - 1) / 2
+            points = centers * grid_spacing - 1
+            sdf = self.evaluate_in_batches(points, latent_code, return_cpu_tensor=False)
+
+            if block_size == 1:
+                voxels[origins[:, 0], origins[:, 1], origins[:, 2]] = sdf
+                return voxels
+
+            # Distance from the block center to its farthest voxel plus one voxel, so that every voxel
+            # adjacent to a sign change is evaluated exactly
+            radius = (math.sqrt(3) * (block_size - 1) / 2 + 1) * grid_spacing * ADAPTIVE_VOXELIZATION_MARGIN
+            far = torch.abs(sdf - level) > radius
+
+            block_count = (voxel_resolution + block_size - 1) // block_size
+            block_values = torch.full((block_count, block_count, block_count), float('nan'), device=self.device)
+            far_blocks = origins[far, :] // block_size
+            block_values[far_blocks[:, 0], far_blocks[:, 1], far_blocks[:, 2]] = sdf[far]
+            for dim in range(3):
+                block_values = block_values.repeat_interleave(block_size, dim=dim)
+            block_values = block_values[:voxel_resolution, :voxel_resolution, :voxel_resolution]
+            mask = ~torch.isnan(block_values)
+            voxels[mask] = block_values[mask]
+
+            block_size //= 2
+            offsets = torch.tensor([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], device=self.device) * block_size
+            origins = (origins[~far, :].unsqueeze(1) + offsets.unsqueeze(0)).reshape(-1, 3)
+            origins = origins[torch.all(origins < voxel_resolution, dim=1), :]
+
+    def get_voxels(self, latent_code, voxel_resolution, sphere_only=True, pad=True, adaptive=False, level=0, return_torch_tensor=False):
         if not (voxel_resolution, sphere_only) in sdf_voxelization_helper:
             helper_data = SDFVoxelizationHelperData(self.device, voxel_resolution, sphere_only)
             sdf_voxelization_helper[(voxel_resolution, sphere_only)] = helper_data
         else:
             helper_data = sdf_voxelization_helper[(voxel_resolution, sphere_only)]
 
+        # A stack of latent codes of shape (n, latent_code_size) results in n voxel volumes of shape (n, res, res, res)
+        is_batch = len(latent_code.shape) == 2
+        batch_shape = (latent_code.shape[0],) if is_batch else ()
+
+        if self.cache is not None and not is_batch:
+            cache_key = self.cache.get_key(self.get_parameter_fingerprint(), 'voxels', latent_code, voxel_resolution, sphere_only, pad, adaptive, level, self.inference_dtype)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                if return_torch_tensor:
+                    return torch.tensor(cached['voxels'], device=self.device)
+                return cached['voxels']
+
         with torch.no_grad():
-            distances = self.evaluate_in_batches(helper_data.sample_points, latent_code).numpy()
-        
-        if sphere_only:
-            voxels = np.ones((voxel_resolution, voxel_resolution, voxel_resolution), dtype=np.float32)
-            voxels[helper_data.unit_sphere_mask] = distances
+            if adaptive:
+                if is_batch:
+                    voxels = torch.stack([self._get_voxels_adaptive(code, voxel_resolution, level=level) for code in latent_code])
+                else:
+                    voxels = self._get_voxels_adaptive(latent_code, voxel_resolution, level=level)
+                if sphere_only:
+                    voxels[..., ~helper_data.unit_sphere_mask_tensor] = 1
+            else:
+                if is_batch:
+                    distances = self.evaluate_multiple_in_batches(helper_data.sample_points, latent_code, return_cpu_tensor=False)
+                else:
+                    distances = self.evaluate_in_batches(helper_data.sample_points, latent_code, return_cpu_tensor=False)
+                if sphere_only:
+                    voxels = torch.ones(batch_shape + (voxel_resolution, voxel_resolution, voxel_resolution), device=self.device)
+                    voxels[..., helper_data.unit_sphere_mask_tensor] = distances
+                else:
+                    voxels = distances.reshape(batch_shape + (voxel_resolution, voxel_resolution, voxel_resolution))
+
+        if not sphere_only and pad:
+            voxels = F.pad(voxels, (1, 1, 1, 1, 1, 1), mode='constant', value=1)
+
+        if self.cache is not None and not is_batch:
+            self.cache.put(cache_key, {'voxels': voxels.cpu().numpy()})
+
+        if return_torch_tensor:
+            return voxels
         else:
-            voxels = distances.reshape(voxel_resolution, voxel_resolution, voxel_resolution)
-            if pad:
-                voxels = np.pad(voxels, 1, mode='constant', constant_values=1)
+            return voxels.cpu().numpy()
 
-        return voxels
+    def get_meshes(self, latent_codes, voxel_resolution = 64, sphere_only = True, level=0, adaptive=False):
+        # Returns one mesh per latent code, or None for latent codes that result in an empty surface.
+        # Marching cubes runs for all shapes at once on the device of the network.
+        voxels = self.get_voxels(latent_codes, voxel_resolution=voxel_resolution, sphere_only=sphere_only, adaptive=adaptive, level=level, return_torch_tensor=True)
+        return get_meshes_from_voxels(voxels, voxel_resolution, level=level)
 
-    def get_mesh(self, latent_code, voxel_resolution = 64, sphere_only = True, raise_on_empty=False, level=0):
-        size = 2
-        
-        voxels = self.get_voxels(latent_code, voxel_resolution=voxel_resolution, sphere_only=sphere_only)
-        voxels = np.pad(voxels, 1, mode='constant', constant_values=1)
-        try:
-            vertices, faces, normals, _ = skimage.measure.marching_cubes_lewiner(voxels, level=level, spacing=(size / voxel_resolution, size / voxel_resolution, size / voxel_resolution))
-        except ValueError as value_error:
-            if raise_on_empty:
-                raise value_error
+    def get_mesh(self, latent_code, voxel_resolution = 64, sphere_only = True, raise_on_empty=False, level=0, adaptive=False):
+        if self.cache is not None:
+            cache_key = self.cache.get_key(self.get_parameter_fingerprint(), 'mesh', latent_code, voxel_resolution, sphere_only, level, adaptive, self.inference_dtype)
+            cached = self.cache.get(cache_key)
+        else:
+            cached = None
+
+        if cached is not None:
+            if cached['faces'].shape[0] == 0:
+                mesh = None
             else:
-                return None
-        
-        vertices -= size / 2
-        mesh = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_normals=normals)
+                mesh = trimesh.Trimesh(vertices=cached['vertices'], faces=cached['faces'], vertex_normals=cached['normals'])
+        else:
+            mesh = self.get_meshes(latent_code.unsqueeze(0), voxel_resolution=voxel_resolution, sphere_only=sphere_only, level=level, adaptive=adaptive)[0]
+            if self.cache is not None:
+                if mesh is None:
+                    self.cache.put(cache_key, {'vertices': np.zeros((0, 3)), 'faces': np.zeros((0, 3), dtype=np.int64), 'normals': np.zeros((0, 3))})
+                else:
+                    self.cache.put(cache_key, {'vertices': mesh.vertices, 'faces': mesh.faces, 'normals': mesh.vertex_normals})
+
+        if mesh is None and raise_on_empty:
+            raise ValueError("Surface level must be within volume data range.")
         return mesh
 
     def get_uniform_surface_points(self, latent_code, point_count=1000, voxel_resolution=64, sphere_only=True, level=0):
@@ -116,14 +418,7 @@ class SDFNet(SavableModule):
         return mesh.sample(point_count)
 
     def get_normals(self, latent_code, points):
-        if latent_code.requires_grad or points.requires_grad:
-            raise Exception('get_normals may only be called with tensors that don\'t require grad.')
-        
-        points.requires_grad = True
-        latent_codes = latent_code.repeat(points.shape[0], 1)
-        sdf = self(points, latent_codes)
-        sdf.backward(torch.ones(sdf.shape[0], device=self.device))
-        normals = points.grad
+        _, normals = self.evaluate_with_gradients(points, latent_code)
         normals /= torch.norm(normals, dim=1).unsqueeze(dim=1)
         return normals
 
@@ -132,15 +427,9 @@ class SDFNet(SavableModule):
             points = get_points_in_unit_sphere(n=sample_size, device=self.device) * 1.1
         else:
             points = torch.rand((sample_size, 3), device=self.device) * 2.2 - 1
-        points.requires_grad = True
-        latent_codes = latent_code.repeat(points.shape[0], 1)
-    
-        sdf = self(points, latent_codes)
 
-        sdf.backward(torch.ones((sdf.shape[0]), device=self.device))
-        normals = points.grad
+        sdf, normals = self.evaluate_with_gradients_in_batches(points, latent_code)
         normals /= torch.norm(normals, dim=1).unsqueeze(dim=1)
-        points.requires_grad = False
 
         # Move points towards surface by the amount given by the signed distance
         points -= normals * sdf.unsqueeze(dim=1)
@@ -155,14 +444,54 @@ class SDFNet(SavableModule):
         else:
             return points
 
-    def get_surface_points_in_batches(self, latent_code, amount = 1000):
-        result = torch.zeros((amount, 3), device=self.device)
-        position = 0
-        iteration_limit = 20
-        while position < amount and iteration_limit > 0:
-            points = self.get_surface_points(latent_code, sample_size=amount * 6)
-            amount_used = min(amount - position, points.shape[0])
-            result[position:position+amount_used, :] = points[:amount_used, :]
-            position += amount_used
-            iteration_limit -= 1
-        return result
+    def get_surface_points_in_batches(self, latent_code, amount = 1000, return_normals=False, level=0, sample_size=None, projection_steps=4, tolerance=0.001, sdf_cutoff=0.1, resample_ratio=0.5, resample_spread=0.05, iteration_limit=20):
+        # Returns exactly amount points on the level set (and their normals).
+        # Candidates are moved onto the surface with Newton steps p -= (sdf - level) * gradient / |gradient|^2.
+        # After the first round, part of the candidates are drawn around previously accepted points,
+        # which makes most of them converge, while the rest are drawn uniformly so that no part of the surface is missed.
+        # Raises a ValueError if amount points aren't found within iteration_limit rounds.
+        if sample_size is None:
+            sample_size = amount * 2
+        accepted_points = []
+        accepted_normals = []
+        accepted_count = 0
+
+        for iteration in range(iteration_limit):
+            if accepted_count >= amount:
+                break
+            uniform_count = sample_size if accepted_count == 0 else int(sample_size * (1 - resample_ratio))
+            points = get_points_in_unit_sphere(n=uniform_count, device=self.device) * 1.1
+            if accepted_count > 0:
+                all_accepted = torch.cat(accepted_points)
+                seeds = all_accepted[torch.randint(all_accepted.shape[0], (sample_size - points.shape[0],), device=self.device), :]
+                points = torch.cat((points, seeds + torch.randn_like(seeds) * resample_spread))
+
+            for step in range(projection_steps + 1):
+                sdf, gradients = self.evaluate_with_gradients_in_batches(points, latent_code)
+                if step == 0:
+                    # Discard points with truncated SDF values, their gradients don't point to the surface
+                    mask = torch.abs(sdf - level) < sdf_cutoff
+                    points, sdf, gradients = points[mask, :], sdf[mask], gradients[mask, :]
+                if step == projection_steps:
+                    break
+                step_size = (sdf - level) / torch.sum(gradients ** 2, dim=1)
+                points = points - gradients * torch.clamp(step_size, -sdf_cutoff, sdf_cutoff).unsqueeze(1)
+
+            normals = gradients / torch.norm(gradients, dim=1).unsqueeze(1)
+            mask = (torch.abs(sdf - level) < tolerance) & torch.all(torch.isfinite(points), dim=1) & torch.all(torch.isfinite(normals), dim=1) & (torch.norm(points, dim=1) < 1.1)
+            accepted_points.append(points[mask, :])
+            accepted_normals.append(normals[mask, :])
+            accepted_count += accepted_points[-1].shape[0]
+
+        if accepted_count < amount:
+            raise ValueError('Found only {:d} of {:d} surface points for this latent code in {:d} iterations.'.format(accepted_count, amount, iteration_limit))
+
+        # Pick a random subset so that the result isn't biased towards the uniform samples of the first round
+        indices = torch.randperm(accepted_count, device=self.device)[:amount]
+        points = torch.cat(accepted_points)[indices, :]
+        normals = torch.cat(accepted_normals)[indices, :]
+
+        if return_normals:
+            return points, normals
+        else:
+            return points
@@ -0,0 +1,156 @@
+import torch
+import numpy as np
+import math
+import sys
+from util import device
+
+# Metrics for generative models of 3D shapes, computed from point clouds of shape (shape count, point count, 3)
+# such as the ones returned by metrics.sample_point_clouds.
+#
+# Distances between shapes are computed in tiles of shape pairs, so that the memory needed for the point-to-point
+# distances stays below MAX_TILE_ELEMENTS. Coverage, MMD and 1-NNA are then derived from a single distance matrix
+# between all generated and reference shapes.
+#
+# The Chamfer distance is the mean squared distance to the nearest neighbor, summed over both directions.
+# The EMD is the mean distance between matched points, approximated with the Sinkhorn algorithm on a fixed subset of
+# EMD_POINT_COUNT points of each cloud, so that a tile holds about a thousand shape pairs.
+# The transport plan is rounded to exact marginals, so the approximation is the cost of a valid plan and never below the exact EMD
+# of the subsets. Against scipy.optimize.linear_sum_assignment on the same 256 point subsets of sphere and box surfaces,
+# it is 1-4% too high and 1e-5 to 4e-5 for identical clouds.
+
+MAX_TILE_ELEMENTS = 2**26
+
+EMD_POINT_COUNT = 256
+EMD_ITERATIONS = 100
+# The regularization of the Sinkhorn algorithm is annealed from the largest point distance down to this value
+EMD_EPSILON = 0.002
+# Further iterations at the final regularization, until the mass of the rows of all plans of a tile is off by less than EMD_TOLERANCE
+EMD_MAX_CONVERGENCE_ITERATIONS = 200
+EMD_TOLERANCE = 0.005
+# The convergence is checked every few iterations, since every check synchronizes with the device
+EMD_CHECK_INTERVAL = 10
+
+def _get_tile_size(point_count1, point_count2):
+    return max(1, int(math.sqrt(MAX_TILE_ELEMENTS / (point_count1 * point_count2))))
+
+def _get_squared_distances(points1, points2):
+    # Takes clouds of shape (a, P, 3) and (b, Q, 3) and returns the squared point distances of shape (a, P, b, Q).
+    # All pairs of the tile are computed with a single matrix multiplication.
+    a, point_count1, _ = points1.shape
+    b, point_count2, _ = points2.shape
+    points1 = points1.reshape(-1, 3)
+    points2 = points2.reshape(-1, 3)
+    distances = torch.addmm(torch.sum(points2 ** 2, dim=1).unsqueeze(0), points1, points2.t(), alpha=-2)
+    distances += torch.sum(points1 ** 2, dim=1).unsqueeze(1)
+    return distances.clamp_(min=0).reshape(a, point_count1, b, point_count2)
+
+def _get_chamfer_distances(points1, points2):
+    distances = _get_squared_distances(points1, points2)
+    return distances.min(dim=3)[0].mean(dim=1) + distances.min(dim=1)[0].mean(dim=2)
+
+def _get_emd(points1, points2, iterations=EMD_ITERATIONS, epsilon=EMD_EPSILON, max_convergence_iterations=EMD_MAX_CONVERGENCE_ITERATIONS, tolerance=EMD_TOLERANCE):
+    # Log domain Sinkhorn iterations with uniform weights for all pairs of the tile at once
+    cost = _get_squared_distances(points1, points2).sqrt_().permute(0, 2, 1, 3)
+    point_count1, point_count2 = cost.shape[2], cost.shape[3]
+    log_weight1 = -math.log(point_count1)
+    log_weight2 = -math.log(point_count2)
+    f = torch.zeros(cost.shape[:3], device=cost.device)
+    g = torch.zeros(cost.shape[:2] + (point_count2,), device=cost.device)
+    max_epsilon = cost.max().item() + epsilon
+    for i in range(iterations + max_convergence_iterations):
+        current_epsilon = max(epsilon, max_epsilon * (epsilon / max_epsilon) ** (i / max(1, iterations - 1)))
+        next_f = current_epsilon * (log_weight1 - torch.logsumexp((g[:, :, None, :] - cost) / current_epsilon, dim=3))
+        if i > iterations and (i - iterations) % EMD_CHECK_INTERVAL == 0:
+            # After the update of g, the columns of the plan have the right mass and row k has the mass
+            # exp((f_k - next_f_k) / epsilon) / point_count1, so the error is known without computing the plan
+            row_error = torch.abs(torch.expm1((f - next_f) / current_epsilon)).mean(dim=2).max().item()
+            if row_error < tolerance:
+                break
+        f = next_f
+        g = current_epsilon * (log_weight2 - torch.logsumexp((f[:, :, :, None] - cost) / current_epsilon, dim=2))
+    plan = torch.exp((f[:, :, :, None] + g[:, :, None, :] - cost) / current_epsilon)
+
+    # The plan is rounded to one with exactly uniform marginals (Altschuler et al. 2017), so that its cost is that of a valid transport plan:
+    # rows and columns with too much mass are scaled down and the missing mass is distributed proportionally to the remaining error
+    plan *= torch.clamp(math.exp(log_weight1) / plan.sum(dim=3), max=1).unsqueeze(3)
+    plan *= torch.clamp(math.exp(log_weight2) / plan.sum(dim=2), max=1).unsqueeze(2)
+    missing1 = math.exp(log_weight1) - plan.sum(dim=3)
+    missing2 = math.exp(log_weight2) - plan.sum(dim=2)
+    plan += missing1.unsqueeze(3) * missing2.unsqueeze(2) / missing1.sum(dim=2).clamp(min=1e-12)[:, :, None, None]
+    return torch.sum(plan * cost, dim=(2, 3))
+
+def _get_subset(clouds, point_count):
+    # The same points are selected from every cloud, so identical clouds stay identical
+    if clouds.shape[1] <= point_count:
+        return clouds
+    generator = torch.Generator().manual_seed(0)
+    indices = torch.randperm(clouds.shape[1], generator=generator)[:point_count].to(clouds.device)
+    return clouds[:, indices, :]
+
+DISTANCE_FUNCTIONS = {
+    'chamfer': _get_chamfer_distances,
+    'emd': _get_emd
+}
+
+def get_distance_matrix(clouds1, clouds2=None, distance='chamfer'):
+    ''' Returns the distances between all pairs of clouds as a tensor of shape (shape count 1, shape count 2).
+    If clouds2 is None, the distances between the shapes of clouds1 are computed and only half of the tiles are evaluated. '''
+    distance_function = DISTANCE_FUNCTIONS[distance]
+    symmetric = clouds2 is None
+    clouds1 = torch.as_tensor(clouds1, dtype=torch.float32).to(device)
+    clouds2 = clouds1 if symmetric else torch.as_tensor(clouds2, dtype=torch.float32).to(device)
+    if distance == 'emd':
+        clouds1, clouds2 = _get_subset(clouds1, EMD_POINT_COUNT), _get_subset(clouds2, EMD_POINT_COUNT)
+    tile_size = _get_tile_size(clouds1.shape[1], clouds2.shape[1])
+
+    result = torch.zeros((clouds1.shape[0], clouds2.shape[0]), device=device)
+    with torch.no_grad():
+        for i in range(0, clouds1.shape[0], tile_size):
+            for j in range(i if symmetric else 0, clouds2.shape[0], tile_size):
+                tile = distance_function(clouds1[i:i + tile_size, :, :], clouds2[j:j + tile_size, :, :])
+                result[i:i + tile_size, j:j + tile_size] = tile
+                if symmetric and j != i:
+                    result[j:j + tile_size, i:i + tile_size] = tile.t()
+    return result
+
+def get_metrics_from_distance_matrix(distances, generated_count):
+    ''' Takes the distances between all shapes, with the generated shapes first and the reference shapes after them. '''
+    reference_count = distances.shape[0] - generated_count
+    generated_to_reference = distances[:generated_count, generated_count:]
+
+    # Fraction of reference shapes that are the nearest neighbor of at least one generated shape
+    coverage = torch.unique(generated_to_reference.argmin(dim=1)).shape[0] / reference_count
+    # Distance from each reference shape to its nearest generated shape, averaged
+    minimum_matching_distance = generated_to_reference.min(dim=0)[0].mean().item()
+
+    # Accuracy of a 1-nearest-neighbor classifier that distinguishes generated and reference shapes, 0.5 is optimal
+    distances = distances.clone()
+    distances.fill_diagonal_(float('inf'))
+    labels = torch.cat((torch.zeros(generated_count, device=distances.device), torch.ones(reference_count, device=distances.device)))
+    nearest_neighbors = distances.argmin(dim=1)
+    nearest_neighbor_accuracy = (labels[nearest_neighbors] == labels).float().mean().item()
+
+    return {
+        'coverage': coverage,
+        'mmd': minimum_matching_distance,
+        '1-nna': nearest_neighbor_accuracy
+    }
+
+def get_metrics(generated_clouds, reference_clouds, distances=('chamfer', 'emd')):
+    ''' Returns COV, MMD and 1-NNA for each distance, with keys such as "coverage-chamfer". '''
+    clouds = np.concatenate((np.asarray(generated_clouds), np.asarray(reference_clouds)), axis=0)
+    result = {}
+    for distance in distances:
+        distance_matrix = get_distance_matrix(clouds, distance=distance)
+        for name, value in get_metrics_from_distance_matrix(distance_matrix, len(generated_clouds)).items():
+            result[name + '-' + distance] = value
+    return result
+
+
+if __name__ == '__main__':
+    # python3 point_cloud_metrics.py data/generated_point_cloud_sample.npy data/dataset_point_cloud_sample.npy
+    generated_clouds = np.load(sys.argv[1])
+    reference_clouds = np.load(sys.argv[2])
+    distances = ('chamfer',) if 'chamfer_only' in sys.argv else ('chamfer', 'emd')
+    for name, value in get_metrics(generated_clouds, reference_clouds, distances=distances).items():
+        print('{:s}: {:.6f}'.format(name, value))
@@ -14,7 +14,7 @@ from rendering.binary_voxels_to_mesh import create_binary_voxel_mesh
 from rendering.shader import Shader
 
 import cv2
-import skimage.measure
+from marching_cubes import marching_cubes
 
 from threading import Thread, Lock
 import torch
@@ -109,28 +109,26 @@ class MeshRenderer():
 
     def set_voxels(self, voxels, use_marching_cubes=True, shade_smooth=False, pad=True, level=0):
         if use_marching_cubes:
-            if type(voxels) is torch.Tensor:
-                if len(voxels.shape) > 3:
-                    voxels = voxels.squeeze()
-                voxels = voxels.cpu().numpy()
+            voxels = torch.as_tensor(voxels)
+            if len(voxels.shape) > 3:
+                voxels = voxels.squeeze()
             voxel_resolution = voxels.shape[1]
             if pad:
-                voxels = np.pad(voxels, 1, mode='constant', constant_values=1)
-            try:
-                vertices, faces, normals, _ = skimage.measure.marching_cubes_lewiner(voxels, level=level, spacing=(2.0 / voxel_resolution, 2.0 / voxel_resolution, 2.0 / voxel_resolution))
-                vertices = vertices[faces, :].astype(np.float32) - 1
-                self.ground_level = np.min(vertices[:, 1]).item()
-
-                if shade_smooth:
-                    normals = normals[faces, :].astype(np.float32)
-                else:
-                    normals = np.cross(vertices[:, 1, :] - vertices[:, 0, :], vertices[:, 2, :] - vertices[:, 0, :])
-                    normals = np.repeat(normals, 3, axis=0)
-
-                self._update_buffers(vertices.reshape((-1)), normals.reshape((-1)))
-                self.model_size = 1.4
-            except ValueError:
-                pass # Voxel array contains no sign change
+                voxels = torch.nn.functional.pad(voxels, (1, 1, 1, 1, 1, 1), mode='constant', value=1)
+            vertices, faces, normals = marching_cubes(voxels, level=level, spacing=(2.0 / voxel_resolution, 2.0 / voxel_resolution, 2.0 / voxel_resolution))
+            if faces.shape[0] == 0:
+                return # Voxel array contains no sign change
+            vertices = vertices[faces, :].cpu().numpy().astype(np.float32) - 1
+            self.ground_level = np.min(vertices[:, 1]).item()
+
+            if shade_smooth:
+                normals = normals[faces, :].cpu().numpy().astype(np.float32)
+            else:
+                normals = np.cross(vertices[:, 1, :] - vertices[:, 0, :], vertices[:, 2, :] - vertices[:, 0, :])
+                normals = np.repeat(normals, 3, axis=0)
+
+            self._update_buffers(vertices.reshape((-1)), normals.reshape((-1)))
+            self.model_size = 1.4
         else:
             vertices, normals = create_binary_voxel_mesh(voxels)
             vertices -= (voxels.shape[0] + 1) / 2
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 import random
 import math
@@ -6,13 +7,31 @@ from tqdm import tqdm
 from PIL import Image
 import os
 
-from model.sdf_net import SDFNet, LATENT_CODES_FILENAME
-from util import device, ensure_directory
+from model.sdf_net import SDFNet, LATENT_CODES_FILENAME, ADAPTIVE_VOXELIZATION_MARGIN
+from util import device, ensure_directory, get_voxel_coordinates
 from rendering.math import get_camera_transform
+from rendering.render_cache import RenderCache
 from scipy.spatial.transform import Rotation
 
 BATCH_SIZE = 100000
 
+# Resolution of the coarse SDF grid that is used to skip empty space
+DISTANCE_BOUND_RESOLUTION = 32
+# Largest step of the primary rays when marching with the network
+MAX_STEP = 0.02
+# Largest step of the shadow rays when marching with the network
+MAX_SHADOW_STEP = 0.1
+# Number of rays that render_images processes at once
+RAYS_PER_TILE = 2**20
+# Largest number of steps of the shadow rays
+SHADOW_ITERATIONS = 200
+# Adaptive antialiasing supersamples the pixels whose normal differs from a neighbor by more than 20 degrees
+ADAPTIVE_ANTIALIASING_NORMAL_THRESHOLD = math.cos(math.radians(20))
+# ... or whose color differs from a neighbor by more than this, out of 255
+ADAPTIVE_ANTIALIASING_COLOR_THRESHOLD = 24
+# In progressive rendering, the rays start this far in front of the closest hit of the coarser image around them
+PROGRESSIVE_DEPTH_MARGIN = 0.05
+
 def get_default_coordinates():
     camera_transform = get_camera_transform(2.2, 147, 20)
     camera_position = np.matmul(np.linalg.inv(camera_transform), np.array([0, 0, 0, 1]))[:3]
@@ -22,49 +41,185 @@ def get_default_coordinates():
 
 camera_position, light_position = get_default_coordinates()
 
-def get_normals(sdf_net, points, latent_code):
-    batch_count = points.shape[0] // BATCH_SIZE
-    result = torch.zeros((points.shape[0], 3), device=points.device)
-    for i in range(batch_count):
-        result[BATCH_SIZE * i:BATCH_SIZE * (i+1), :] = sdf_net.get_normals(latent_code, points[BATCH_SIZE * i:BATCH_SIZE * (i+1), :])
-    
-    if points.shape[0] > BATCH_SIZE * batch_count:
-        result[BATCH_SIZE * batch_count:, :] = sdf_net.get_normals(latent_code, points[BATCH_SIZE * batch_count:, :])
-    return result
+def get_normals(sdf_net, points, latent_code, shape_indices=None):
+    _, normals = sdf_net.evaluate_with_gradients_in_batches(points, latent_code, shape_indices=shape_indices)
+    normals /= torch.norm(normals, dim=1).unsqueeze(dim=1)
+    return normals
+
+
+class DistanceBound():
+    ''' Conservative lower bound of the SDF of one or more shapes, baked once into a coarse grid of SDF values per shape.
+    Rays that are far from the surface according to the bound can take large steps without evaluating the network. '''
+    def __init__(self, sdf_net, latent_codes, size=1.0, resolution=DISTANCE_BOUND_RESOLUTION):
+        # The grid covers the cube [-size, size]^3, which should contain the sphere that the rays are marched in
+        if len(latent_codes.shape) == 1:
+            latent_codes = latent_codes.unsqueeze(0)
+        self.size = size
+        self.resolution = resolution
+        self.spacing = 2 * size / (resolution - 1)
+        points = get_voxel_coordinates(resolution, size=size, return_torch_tensor=True).to(device)
+        self.values = sdf_net.evaluate_multiple_in_batches(points, latent_codes, return_cpu_tensor=False).reshape(-1, resolution, resolution, resolution)
+        self.corner_offsets = torch.tensor([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], device=device)
+
+    def get_lower_bound(self, points, shape_indices=None):
+        # For every grid point c, sdf(p) >= sdf(c) - L * |p - c|, if the network is L-Lipschitz.
+        # As in the adaptive voxelization, L is assumed to be ADAPTIVE_VOXELIZATION_MARGIN.
+        # The bound uses the best of the eight corners of the cell that contains the point.
+        # Outside of the grid, the bound is the distance to the grid, since the surface is assumed to lie inside of it.
+        if shape_indices is None:
+            shape_indices = torch.zeros(points.shape[0], dtype=torch.int64, device=points.device)
+        cells = torch.floor((points + self.size) / self.spacing).long().clamp_(0, self.resolution - 2)
+        bound = torch.full((points.shape[0],), float('-inf'), device=points.device)
+        for offset in self.corner_offsets:
+            corners = cells + offset
+            corner_positions = corners.to(points.dtype) * self.spacing - self.size
+            distances = torch.norm(points - corner_positions, dim=1)
+            bound = torch.max(bound, self.values[shape_indices, corners[:, 0], corners[:, 1], corners[:, 2]] - distances * ADAPTIVE_VOXELIZATION_MARGIN)
+        distance_to_grid = torch.norm(torch.clamp(torch.abs(points) - self.size, min=0), dim=1)
+        outside = distance_to_grid > 0
+        bound[outside] = distance_to_grid[outside]
+        return bound
+
+
+class VoxelSDF():
+    ''' Takes the place of the SDFNet in the ray marcher to render SDF volumes instead of latent codes, without a network in the loop.
+    The latent codes passed to the ray marcher are volumes of shape (resolution, resolution, resolution) that sample [-1, 1]^3
+    like SDFNet.get_voxels with sphere_only=False and pad=False. The volumes of Autoencoder.decode and the voxel GAN generators
+    use the same layout. Values are interpolated trilinearly with grid_sample and normals are computed with central differences.
+    Outside of the volume, the distance to the volume is added to the value at its border. '''
+    inference_dtype = None
+
+    def get_parameter_fingerprint(self):
+        # The volumes themselves are passed as latent codes
+        return 'voxels'
+
+    def _sample(self, volume, points):
+        clamped_points = torch.clamp(points, -1, 1)
+        # grid_sample takes the coordinates in the order of the last, middle and first axis of the volume
+        grid = clamped_points.flip(-1).reshape(1, -1, 1, 1, 3)
+        values = F.grid_sample(volume.reshape((1, 1) + volume.shape), grid, mode='bilinear', padding_mode='border', align_corners=True)
+        return values.reshape(-1) + torch.norm(points - clamped_points, dim=1)
+
+    def evaluate_shapes_in_batches(self, points, latent_codes, shape_indices, batch_size=None):
+        if latent_codes.shape[0] == 1:
+            return self._sample(latent_codes[0], points)
+        # The points are sorted by shape, so that every volume is sampled with a single call
+        result = torch.zeros(points.shape[0], device=points.device)
+        order = torch.argsort(shape_indices, stable=True)
+        counts = torch.bincount(shape_indices, minlength=latent_codes.shape[0]).tolist()
+        for volume, shape_order in zip(latent_codes, torch.split(order, counts)):
+            if shape_order.shape[0] > 0:
+                result[shape_order] = self._sample(volume, points[shape_order, :])
+        return result
+
+    def evaluate_in_batches(self, points, latent_code, batch_size=None, return_cpu_tensor=True):
+        result = self._sample(latent_code, points)
+        return result.cpu() if return_cpu_tensor else result
+
+    def evaluate_multiple_in_batches(self, points, latent_codes, batch_size=None, return_cpu_tensor=True):
+        result = torch.stack([self._sample(volume, points) for volume in latent_codes])
+        return result.cpu() if return_cpu_tensor else result
+
+    def evaluate_with_gradients_in_batches(self, points, latent_code, batch_size=None, shape_indices=None):
+        if shape_indices is None:
+            latent_code = latent_code.unsqueeze(0)
+            shape_indices = torch.zeros(points.shape[0], dtype=torch.int64, device=points.device)
+        # The step of the central differences is half of the voxel size
+        step = 1 / (latent_code.shape[-1] - 1)
+        offsets = torch.eye(3, device=points.device) * step
+        sample_points = torch.cat([points] + [points + offset for offset in offsets] + [points - offset for offset in offsets])
+        values = self.evaluate_shapes_in_batches(sample_points, latent_code, shape_indices.repeat(7)).reshape(7, -1)
+        gradients = (values[1:4, :] - values[4:7, :]).t() / (2 * step)
+        return values[0, :], gradients
+
+
+def bake_voxels(sdf_net, latent_codes, voxel_resolution=128):
+    # Returns volumes of shape (n, voxel_resolution, voxel_resolution, voxel_resolution) that can be rendered with render_voxels
+    with torch.no_grad():
+        return sdf_net.get_voxels(latent_codes.reshape(-1, latent_codes.shape[-1]), voxel_resolution, sphere_only=False, pad=False, return_torch_tensor=True)
 
+def render_voxels(voxels, camera_positions=None, **kwargs):
+    ''' Renders SDF volumes, such as the ones returned by bake_voxels, Autoencoder.decode or the voxel GAN generators.
+    Takes a single volume or a batch of volumes, with or without a channel dimension, and returns a list of lists of images like render_images.
+    All keyword arguments of render_images are supported. '''
+    voxels = torch.as_tensor(voxels, dtype=torch.float32).to(device)
+    voxels = voxels.reshape((-1,) + voxels.shape[-3:])
+    # Sampling the volume costs less than the lookup in the distance bound, so empty space skipping is off by default
+    kwargs.setdefault('skip_empty_space', False)
+    return render_images(VoxelSDF(), voxels, camera_positions, **kwargs)
 
-def get_shadows(sdf_net, points, light_position, latent_code, threshold = 0.001, sdf_offset=0, radius=1.0):
-    ray_directions = light_position[np.newaxis, :] - points
-    ray_directions /= np.linalg.norm(ray_directions, axis=1)[:, np.newaxis]
-    ray_directions_t = torch.tensor(ray_directions, device=device, dtype=torch.float32)
+
+def get_turntable_camera_positions(count, camera_distance=2.2, rotation_x=20, start_angle=147):
+    # Camera positions on a circle around the vertical axis, starting at the default camera position
+    positions = []
+    for i in range(count):
+        camera_transform = get_camera_transform(camera_distance, start_angle + 360 * i / count, rotation_x)
+        positions.append(np.matmul(np.linalg.inv(camera_transform), np.array([0, 0, 0, 1]))[:3])
+    return np.stack(positions)
+
+
+def get_shadows(sdf_net, points, light_position, latent_code, threshold = 0.001, sdf_offset=0, radius=1.0, distance_bound=None, shape_indices=None, iterations=SHADOW_ITERATIONS):
+    # Takes points as a numpy array and returns 1 for the points that are in shadow and 0 for the others.
+    # If shape_indices is given, latent_code is a stack of latent codes and shape_indices selects the shape of each point.
+    latent_codes, shape_indices = _get_shape_indices(latent_code, shape_indices, points.shape[0])
     points = torch.tensor(points, device=device, dtype=torch.float32)
-    
-    points += ray_directions_t * 0.1
-
-    indices = torch.arange(points.shape[0])
-    shadows = torch.zeros(points.shape[0])
-
-    for i in tqdm(range(200)):
-        test_points = points[indices, :]
-        sdf = sdf_net.evaluate_in_batches(test_points, latent_code, return_cpu_tensor=False) + sdf_offset
-        sdf = torch.clamp_(sdf, -0.1, 0.1)
-        points[indices, :] += ray_directions_t[indices, :] * sdf.unsqueeze(1)
-        
-        hits = (sdf > 0) & (sdf < threshold)
-        shadows[indices[hits]] = 1
-        indices = indices[~hits]
-        
-        misses = points[indices, 1] > radius
-        indices = indices[~misses]
-        
-        if indices.shape[0] < 2:
-            break
+    light_position = torch.tensor(light_position, device=device, dtype=torch.float32)
+    shadows = _get_shadows(sdf_net, latent_codes, shape_indices, points, light_position, threshold, sdf_offset, radius, distance_bound, iterations)
+    return shadows.float().cpu().numpy()
 
-    shadows[indices] = 1
-    return shadows.cpu().numpy()
+def _get_shadows(sdf_net, latent_codes, shape_indices, points, light_position, threshold, sdf_offset, radius, distance_bound, iterations):
+    # Returns a mask of the points that are in shadow. Shadow rays miss once they are above the sphere with the given radius.
+    ray_directions = light_position.unsqueeze(0) - points
+    ray_directions /= torch.norm(ray_directions, dim=1).unsqueeze(1)
+    points = points + ray_directions * 0.1
+    indices = torch.arange(points.shape[0], device=points.device)
+    return _trace(sdf_net, latent_codes, shape_indices, points, ray_directions, indices, sdf_offset, threshold, MAX_SHADOW_STEP, distance_bound,
+        range(iterations), lambda points: points[:, 1] > radius)[0]
     
 
-def render_image(sdf_net, latent_code, resolution=800, threshold=0.0005, sdf_offset=0, iterations=1000, ssaa=2, radius=1.0, crop=False, color=(0.8, 0.1, 0.1), vertical_cutoff=None):
+def _get_shape_indices(latent_code, shape_indices, point_count):
+    if shape_indices is None:
+        return latent_code.unsqueeze(0), torch.zeros(point_count, dtype=torch.int64, device=device)
+    return latent_code, torch.as_tensor(shape_indices, dtype=torch.int64).to(device)
+
+def _march(sdf_net, latent_codes, shape_indices, points, ray_directions, indices, sdf_offset, threshold, max_step, distance_bound):
+    # Advances the active rays by one step. Rays that are far from the surface according to the distance bound
+    # step by the bound, the others are evaluated with the network, with the rays of all shapes in the same batches.
+    # Returns the indices of the rays that were evaluated with the network and which of them hit the surface.
+    if distance_bound is not None:
+        bound = distance_bound.get_lower_bound(points[indices, :], shape_indices[indices]) + sdf_offset
+        far = bound > max_step
+        far_indices = indices[far]
+        points[far_indices, :] += ray_directions[far_indices, :] * bound[far].unsqueeze(1)
+        indices = indices[~far]
+
+    # A single point is evaluated to a scalar
+    sdf = sdf_net.evaluate_shapes_in_batches(points[indices, :], latent_codes, shape_indices[indices]).reshape(-1) + sdf_offset
+    torch.clamp_(sdf, -max_step, max_step)
+    points[indices, :] += ray_directions[indices, :] * sdf.unsqueeze(1)
+    hits = (sdf > 0) & (sdf < threshold)
+    return indices, hits
+
+def _trace(sdf_net, latent_codes, shape_indices, points, ray_directions, indices, sdf_offset, threshold, max_step, distance_bound, steps, is_miss):
+    # Marches the rays with the given indices until they hit the surface or is_miss is true for their position.
+    # The indices of the active rays are compacted after every step, so that finished rays cost nothing.
+    # Returns a mask of the rays that hit the surface and a mask of the rays that are still active after the last step, which count as hits.
+    # Every ray is marched until it finishes or the steps run out, so the result doesn't depend on which other rays are traced with it.
+    hit_mask = torch.zeros(points.shape[0], dtype=torch.bool, device=points.device)
+    for i in steps:
+        if indices.shape[0] == 0:
+            break
+        network_indices, hits = _march(sdf_net, latent_codes, shape_indices, points, ray_directions, indices, sdf_offset, threshold, max_step, distance_bound)
+        hit_mask[network_indices] = hits
+        indices = indices[~hit_mask[indices] & ~is_miss(points[indices, :])]
+    unfinished_mask = torch.zeros(points.shape[0], dtype=torch.bool, device=points.device)
+    unfinished_mask[indices] = True
+    hit_mask[indices] = True
+    return hit_mask, unfinished_mask
+
+def _get_camera(camera_position, radius):
+    # Returns the camera position, the right and up vectors and the forward vector scaled by the focal distance.
+    # The field of view is chosen so that the sphere with the given radius fills the image.
     camera_forward = camera_position / np.linalg.norm(camera_position) * -1
     camera_distance = np.linalg.norm(camera_position).item()
     up = np.array([0, 1, 0])
@@ -72,121 +227,320 @@ def render_image(sdf_net, latent_code, resolution=800, threshold=0.0005, sdf_off
     camera_right /= np.linalg.norm(camera_right)
     camera_up = np.cross(camera_forward, camera_right)
     camera_up /= np.linalg.norm(camera_up)
-    
-    screenspace_points = np.meshgrid(
-        np.linspace(-1, 1, resolution * ssaa),
-        np.linspace(-1, 1, resolution * ssaa),
-    )
-    screenspace_points = np.stack(screenspace_points)
-    screenspace_points = screenspace_points.reshape(2, -1).transpose()
-    
-    points = np.tile(camera_position, (screenspace_points.shape[0], 1))
-    points = points.astype(np.float32)
-    
     focal_distance = 1.0 / math.tan(math.asin(radius / camera_distance))
-    ray_directions = screenspace_points[:, 0] * camera_right[:, np.newaxis] \
-        + screenspace_points[:, 1] * camera_up[:, np.newaxis] \
-        + focal_distance * camera_forward[:, np.newaxis]
-    ray_directions = ray_directions.transpose().astype(np.float32)
-    ray_directions /= np.linalg.norm(ray_directions, axis=1)[:, np.newaxis]
+    return np.stack((camera_position, camera_right, camera_up, focal_distance * camera_forward))
 
-    b = np.einsum('ij,ij->i', points, ray_directions) * 2
-    c = np.dot(camera_position, camera_position) - radius * radius
-    distance_to_sphere = (-b - np.sqrt(np.power(b, 2) - 4 * c)) / 2
-    indices = np.argwhere(np.isfinite(distance_to_sphere)).reshape(-1)
+def _get_camera_rays(cameras, view_indices, x, y, resolution, radius):
+    # Returns the start points and directions of the rays through the given pixel coordinates of the given views and which of the rays hit the sphere.
+    # The coordinates can be fractional, the pixels (0, 0) and (resolution - 1, resolution - 1) are at the corners of the screen.
+    # The rays that hit the sphere start on its surface, the others start at the camera.
+    camera = cameras[view_indices, :, :]
+    pixel_size = 2 / max(resolution - 1, 1)
+    screenspace_x = x * pixel_size - 1
+    screenspace_y = y * pixel_size - 1
+    ray_directions = screenspace_x.unsqueeze(1) * camera[:, 1, :] + screenspace_y.unsqueeze(1) * camera[:, 2, :] + camera[:, 3, :]
+    ray_directions /= torch.norm(ray_directions, dim=1).unsqueeze(1)
 
-    points[indices] += ray_directions[indices] * distance_to_sphere[indices, np.newaxis]
+    points = camera[:, 0, :].clone()
+    b = torch.sum(points * ray_directions, dim=1) * 2
+    c = torch.sum(points * points, dim=1) - radius * radius
+    distance_to_sphere = (-b - torch.sqrt(b ** 2 - 4 * c)) / 2
+    hits_sphere = torch.isfinite(distance_to_sphere)
+    points[hits_sphere, :] += ray_directions[hits_sphere, :] * distance_to_sphere[hits_sphere].unsqueeze(1)
+    return points, ray_directions, hits_sphere
 
-    points = torch.tensor(points, device=device, dtype=torch.float32)
-    ray_directions_t = torch.tensor(ray_directions, device=device, dtype=torch.float32)
-
-    indices = torch.tensor(indices, device=device, dtype=torch.int64)
-    model_mask = torch.zeros(points.shape[0], dtype=torch.uint8)
-
-    for i in tqdm(range(iterations)):
-        test_points = points[indices, :]
-        sdf = sdf_net.evaluate_in_batches(test_points, latent_code, return_cpu_tensor=False) + sdf_offset
-        torch.clamp_(sdf, -0.02, 0.02)
-        points[indices, :] += ray_directions_t[indices, :] * sdf.unsqueeze(1)
-        
-        hits = (sdf > 0) & (sdf < threshold)
-        model_mask[indices[hits]] = 1
-        indices = indices[~hits]
-        
-        misses = torch.norm(points[indices, :], dim=1) > radius
-        indices = indices[~misses]
-        
-        if indices.shape[0] < 2:
-            break
-        
-    model_mask[indices] = 1
+def _get_tile_rays(cameras, tile_start, tile_end, pixel_indices, image_resolution, view_count, ssaa, subpixels, radius):
+    # Returns the image indices, start points and directions of the rays tile_start to tile_end and which of them hit the sphere.
+    # Pixels are numbered by shape, then view, then row and column. pixel_indices selects the rendered pixels, or all pixels if it is None.
+    # Each pixel covers ssaa x ssaa subpixels of the supersampled image. With subpixels, there is one ray per subpixel,
+    # ordered by pixel and then subpixel, otherwise there is one ray through the center of each pixel.
+    rays_per_pixel = ssaa ** 2 if subpixels else 1
+    ray_indices = torch.arange(tile_start, tile_end, device=device)
+    pixels = ray_indices // rays_per_pixel
+    if pixel_indices is not None:
+        pixel_start = tile_start // rays_per_pixel
+        pixels = pixel_indices[pixel_start:(tile_end - 1) // rays_per_pixel + 1].to(device)[pixels - pixel_start]
+    image_indices = pixels // image_resolution ** 2
+    rows = (pixels // image_resolution) % image_resolution
+    columns = pixels % image_resolution
+    if subpixels:
+        subpixel_indices = ray_indices % rays_per_pixel
+        x = columns * ssaa + subpixel_indices % ssaa
+        y = rows * ssaa + subpixel_indices // ssaa
+    else:
+        x = columns * ssaa + (ssaa - 1) / 2
+        y = rows * ssaa + (ssaa - 1) / 2
+    points, ray_directions, hits_sphere = _get_camera_rays(cameras, image_indices % view_count, x.to(torch.float32), y.to(torch.float32), image_resolution * ssaa, radius)
+    return image_indices, points, ray_directions, hits_sphere
 
-    if vertical_cutoff is not None:
-        model_mask[points[:, 1] > vertical_cutoff] = 0
-        model_mask[points[:, 1] < -vertical_cutoff] = 0
+def _shade_model(shape_indices, points, ray_directions, normal, colors, light_position, seen_by_light):
+    light_direction = light_position.unsqueeze(0) - points
+    light_direction /= torch.norm(light_direction, dim=1).unsqueeze(1)
+    
+    diffuse = torch.sum(light_direction * normal, dim=1)
+    diffuse = torch.clamp(diffuse, 0, 1) * seen_by_light
 
-    normal = get_normals(sdf_net, points[model_mask], latent_code).cpu().numpy()
+    reflect = light_direction - torch.sum(light_direction * normal, dim=1).unsqueeze(1) * normal * 2
+    reflect /= torch.norm(reflect, dim=1).unsqueeze(1)
+    specular = torch.sum(reflect * ray_directions, dim=1)
+    specular = torch.clamp(specular, 0.0, 1.0)
+    specular = torch.pow(specular, 20) * seen_by_light
+    rim_light = -torch.sum(normal * ray_directions, dim=1)
+    rim_light = 1.0 - torch.clamp(rim_light, 0, 1)
+    rim_light = torch.pow(rim_light, 4) * 0.3
 
-    model_mask = model_mask.cpu().numpy().astype(bool)
-    points = points.cpu().numpy()
-    model_points = points[model_mask]
-    
-    seen_by_light = 1.0 - get_shadows(sdf_net, model_points, light_position, latent_code, radius=radius, sdf_offset=sdf_offset)
-    
-    light_direction = light_position[np.newaxis, :] - model_points
-    light_direction /= np.linalg.norm(light_direction, axis=1)[:, np.newaxis]
-    
-    diffuse = np.einsum('ij,ij->i', light_direction, normal)
-    diffuse = np.clip(diffuse, 0, 1) * seen_by_light
-
-    reflect = light_direction - np.einsum('ij,ij->i', light_direction, normal)[:, np.newaxis] * normal * 2
-    reflect /= np.linalg.norm(reflect, axis=1)[:, np.newaxis]
-    specular = np.einsum('ij,ij->i', reflect, ray_directions[model_mask, :])
-    specular = np.clip(specular, 0.0, 1.0)
-    specular = np.power(specular, 20) * seen_by_light
-    rim_light = -np.einsum('ij,ij->i', normal, ray_directions[model_mask, :])
-    rim_light = 1.0 - np.clip(rim_light, 0, 1)
-    rim_light = np.power(rim_light, 4) * 0.3
-
-    color = np.array(color)[np.newaxis, :] * (diffuse * 0.5 + 0.5)[:, np.newaxis]
-    color += (specular * 0.3 + rim_light)[:, np.newaxis]
-
-    color = np.clip(color, 0, 1)
-
-    ground_points = ray_directions[:, 1] < 0
-    ground_points[model_mask] = 0
-    ground_points = np.argwhere(ground_points).reshape(-1)
-    ground_plane = np.min(model_points[:, 1]).item()
-    points[ground_points, :] -= ray_directions[ground_points, :] * ((points[ground_points, 1] - ground_plane) / ray_directions[ground_points, 1])[:, np.newaxis]
-    ground_points = ground_points[np.linalg.norm(points[ground_points, ::2], axis=1) < 3]
-    
-    ground_shadows = get_shadows(sdf_net, points[ground_points, :], light_position, latent_code, sdf_offset=sdf_offset)
+    color = colors[shape_indices, :] * (diffuse * 0.5 + 0.5).unsqueeze(1)
+    color += (specular * 0.3 + rim_light).unsqueeze(1)
+    return torch.clamp(color, 0, 1)
+
+def render_images(sdf_net, latent_codes, camera_positions=None, resolution=800, threshold=0.0005, sdf_offset=0, iterations=1000, ssaa=2, radius=1.0, crop=False, color=(0.8, 0.1, 0.1), vertical_cutoff=None, skip_empty_space=True, tile_size=RAYS_PER_TILE, shadow_iterations=SHADOW_ITERATIONS, adaptive_antialiasing=False, return_buffers=False, buffer_dtype=torch.float32, cache=None):
+    ''' Renders each of the K latent codes from each of the V camera positions and returns a list of K lists of V images.
+    The rays of all images are marched together, so that the network is evaluated in full batches until the last rays finish.
+    The rays are processed in tiles of at most tile_size rays, the ray state of a tile stays on the device and
+    only the finished pixels are copied to the CPU, so the memory on the device doesn't grow with the resolution.
+    color can be a single color or one color per latent code.
+    With adaptive_antialiasing, only the pixels on silhouettes, creases and shadow edges are supersampled instead of all pixels.
+    If a RenderCache is given, images that are in the cache are not rendered again.
+    With return_buffers, the depth, normal, mask and position buffers of each image are computed in the same pass and
+    (images, buffers) is returned, where buffers is a list of K lists of V dicts of numpy arrays:
+    depth is the distance from the camera to the model (inf if the pixel doesn't show the model), normal and position
+    are in world space (0 if the pixel doesn't show the model) and mask is True where the pixel shows the model.
+    The buffers have one value per primary ray, so they have resolution * ssaa pixels per side, or resolution
+    with adaptive_antialiasing, and are not cropped. They are stored as buffer_dtype, such as torch.float16 to halve their size.
+    Buffers are not cached, so the cache is not used with return_buffers. '''
+    if camera_positions is None:
+        camera_positions = camera_position[np.newaxis, :]
+    if cache is not None and not return_buffers:
+        settings = dict(resolution=resolution, threshold=threshold, sdf_offset=sdf_offset, iterations=iterations, ssaa=ssaa, radius=radius, crop=crop,
+            vertical_cutoff=vertical_cutoff, skip_empty_space=skip_empty_space, tile_size=tile_size, shadow_iterations=shadow_iterations, adaptive_antialiasing=adaptive_antialiasing)
+        return _render_images_with_cache(cache, sdf_net, latent_codes, camera_positions, color, settings)
+
+    if adaptive_antialiasing and ssaa > 1:
+        pixels, depth, normals, positions = _render_adaptive(sdf_net, latent_codes, camera_positions, resolution, ssaa, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+            skip_empty_space, tile_size, shadow_iterations, buffer_dtype)
+        image_resolution = resolution
+    else:
+        pixels, depth, normals, positions, _ = _render(sdf_net, latent_codes, camera_positions, resolution * ssaa, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+            skip_empty_space, tile_size, shadow_iterations, return_buffers=return_buffers, buffer_dtype=buffer_dtype)
+        image_resolution = resolution * ssaa
+    image_shape = (latent_codes.shape[0], len(camera_positions), image_resolution, image_resolution)
+    pixels = pixels.reshape(image_shape + (3,)).numpy()
+
+    images = []
+    for shape_index in range(latent_codes.shape[0]):
+        images.append([_get_image(pixels[shape_index, view_index], resolution, ssaa, crop) for view_index in range(len(camera_positions))])
+    if not return_buffers:
+        return images
+    return images, _get_buffers(depth.reshape(image_shape), normals.reshape(image_shape + (3,)), positions.reshape(image_shape + (3,)), buffer_dtype)
+
+def _get_buffers(depth, normals, positions, buffer_dtype):
+    # Takes buffers of shape (K, V, resolution, resolution) and returns a list of K lists of V dicts of numpy arrays
+    mask = torch.isfinite(depth)
+    depth = depth.to(buffer_dtype)
+    return [[{'depth': depth[i, j].numpy(), 'normal': normals[i, j].numpy(), 'mask': mask[i, j].numpy(), 'position': positions[i, j].numpy()}
+        for j in range(depth.shape[1])] for i in range(depth.shape[0])]
+
+def _render(sdf_net, latent_codes, camera_positions, image_resolution, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+        skip_empty_space, tile_size, shadow_iterations, start_depth=None, distance_bound=None, ssaa=1, pixel_indices=None, subpixels=False, ground_planes=None,
+        return_buffers=False, buffer_dtype=torch.float32):
+    # Renders K x V images with image_resolution pixels per side, or only the given pixels, see _get_tile_rays for the order of the rays.
+    # Returns for each ray the color as uint8, the distance from the camera to the model, or inf if the ray misses the model,
+    # and if return_buffers is set, the normal and position of the model in buffer_dtype, all on the CPU, as well as the ground plane of each image.
+    # Rays with a finite start_depth start at that distance from the camera instead of at the sphere.
+    # If ground_planes is given, they are used instead of the lowest visible point of the model in each image.
+    shape_count = latent_codes.shape[0]
+    view_count = len(camera_positions)
+    image_count = shape_count * view_count
+    pixel_count = image_count * image_resolution ** 2 if pixel_indices is None else pixel_indices.shape[0]
+    ray_count = pixel_count * (ssaa ** 2 if subpixels else 1)
+
+    cameras = torch.tensor(np.stack([_get_camera(np.asarray(position, dtype=float), radius) for position in camera_positions]), device=device, dtype=torch.float32)
+    colors = torch.tensor(color, device=device, dtype=torch.float32).reshape(-1, 3).expand(shape_count, 3)
+    light_position_t = torch.tensor(light_position, device=device, dtype=torch.float32)
+
+    # The distance bound is baked once and used for both the primary and the shadow rays
+    if distance_bound is None and skip_empty_space:
+        distance_bound = DistanceBound(sdf_net, latent_codes, size=radius)
+    if start_depth is not None:
+        start_depth = start_depth.reshape(-1)
+
+    # The first pass marches the primary rays and stores the distance from the camera to the model
+    depth = torch.full((ray_count,), float('inf'))
+    # The ground plane of each image is at the lowest visible point of the model, images without a model have no ground
+    find_ground_planes = ground_planes is None
+    if find_ground_planes:
+        ground_planes = torch.full((image_count,), float('inf'), device=device)
+
+    for tile_start in range(0, ray_count, tile_size):
+        tile_end = min(tile_start + tile_size, ray_count)
+        image_indices, points, ray_directions, hits_sphere = _get_tile_rays(cameras, tile_start, tile_end, pixel_indices, image_resolution, view_count, ssaa, subpixels, radius)
+        origins = cameras[image_indices % view_count, 0, :]
+        if start_depth is not None:
+            tile_start_depth = torch.maximum(start_depth[tile_start:tile_end].to(device), torch.norm(points - origins, dim=1))
+            skipped = hits_sphere & torch.isfinite(tile_start_depth)
+            points[skipped, :] = origins[skipped, :] + ray_directions[skipped, :] * tile_start_depth[skipped].unsqueeze(1)
+
+        indices = torch.nonzero(hits_sphere).reshape(-1)
+        model_mask, unfinished_mask = _trace(sdf_net, latent_codes, image_indices // view_count, points, ray_directions, indices, sdf_offset, threshold, MAX_STEP, distance_bound,
+            tqdm(range(iterations)), lambda points: torch.norm(points, dim=1) > radius)
 
-    pixels = np.ones((points.shape[0], 3))
-    pixels[model_mask] = color
-    pixels[ground_points] -= ((1.0 - 0.65) * ground_shadows)[:, np.newaxis]
-    pixels = pixels.reshape((resolution * ssaa, resolution * ssaa, 3))
+        if vertical_cutoff is not None:
+            model_mask &= torch.abs(points[:, 1]) <= vertical_cutoff
 
+        if find_ground_planes:
+            # Rays that ran out of steps are shown as the model, but their position is not on the surface
+            surface_mask = model_mask & ~unfinished_mask
+            ground_planes.scatter_reduce_(0, image_indices[surface_mask], points[surface_mask, 1], reduce='amin')
+        tile_depth = torch.norm(points - origins, dim=1)
+        tile_depth[~model_mask] = float('inf')
+        depth[tile_start:tile_end] = tile_depth.cpu()
+
+    # The second pass shades the model and the ground, with a single shadow pass for the model and ground points of a tile
+    pixels = torch.full((ray_count, 3), 255, dtype=torch.uint8)
+    normals = torch.zeros((ray_count, 3), dtype=buffer_dtype) if return_buffers else None
+    positions = torch.zeros((ray_count, 3), dtype=buffer_dtype) if return_buffers else None
+    for tile_start in range(0, ray_count, tile_size):
+        tile_end = min(tile_start + tile_size, ray_count)
+        image_indices, _, ray_directions, _ = _get_tile_rays(cameras, tile_start, tile_end, pixel_indices, image_resolution, view_count, ssaa, subpixels, radius)
+        shape_indices = image_indices // view_count
+        origins = cameras[image_indices % view_count, 0, :]
+        tile_depth = depth[tile_start:tile_end].to(device)
+        ground_plane = ground_planes[image_indices]
+
+        model_points = torch.nonzero(torch.isfinite(tile_depth)).reshape(-1)
+        ground_points = torch.nonzero((ray_directions[:, 1] < 0) & ~torch.isfinite(tile_depth) & torch.isfinite(ground_plane)).reshape(-1)
+        distance_to_ground = (origins[ground_points, 1] - ground_plane[ground_points]) / -ray_directions[ground_points, 1]
+        on_ground = torch.norm((origins[ground_points, :] + ray_directions[ground_points, :] * distance_to_ground.unsqueeze(1))[:, ::2], dim=1) < 3
+        ground_points = ground_points[on_ground]
+
+        shaded_points = torch.cat((model_points, ground_points))
+        distance = torch.cat((tile_depth[model_points], distance_to_ground[on_ground]))
+        points = origins[shaded_points, :] + ray_directions[shaded_points, :] * distance.unsqueeze(1)
+        shadows = _get_shadows(sdf_net, latent_codes, shape_indices[shaded_points], points, light_position_t, 0.001, sdf_offset, radius, distance_bound, shadow_iterations)
+        model_count = model_points.shape[0]
+
+        normal = get_normals(sdf_net, points[:model_count, :], latent_codes, shape_indices=shape_indices[model_points])
+        color = _shade_model(shape_indices[model_points], points[:model_count, :], ray_directions[model_points, :], normal, colors, light_position_t, 1.0 - shadows[:model_count].float())
+        tile_pixels = torch.full((tile_end - tile_start, 3), 255, dtype=torch.uint8, device=device)
+        tile_pixels[model_points, :] = (color * 255).to(torch.uint8)
+        tile_pixels[ground_points, :] = ((1.0 - (1.0 - 0.65) * shadows[model_count:].float()) * 255).to(torch.uint8).unsqueeze(1)
+        pixels[tile_start:tile_end, :] = tile_pixels.cpu()
+        if return_buffers:
+            model_points = tile_start + model_points.cpu()
+            normals[model_points, :] = normal.to(buffer_dtype).cpu()
+            positions[model_points, :] = points[:model_count, :].to(buffer_dtype).cpu()
+
+    return pixels, depth, normals, positions, ground_planes
+
+def _get_edges(pixels, depth, normals):
+    # Takes the colors, depth and normals of a stack of images and returns a mask of the pixels that differ from
+    # one of their four neighbors in whether they show the model, in their normal or in their color.
+    model_mask = torch.isfinite(depth)
+    pixels = pixels.to(torch.float32)
+    normals = normals.to(torch.float32)
+    edges = torch.zeros(model_mask.shape, dtype=torch.bool)
+    for axis in (1, 2):
+        size = model_mask.shape[axis] - 1
+        model_mask1, model_mask2 = model_mask.narrow(axis, 0, size), model_mask.narrow(axis, 1, size)
+        different = model_mask1 != model_mask2
+        different |= model_mask1 & model_mask2 & (torch.sum(normals.narrow(axis, 0, size) * normals.narrow(axis, 1, size), dim=-1) < ADAPTIVE_ANTIALIASING_NORMAL_THRESHOLD)
+        different |= torch.max(torch.abs(pixels.narrow(axis, 0, size) - pixels.narrow(axis, 1, size)), dim=-1)[0] > ADAPTIVE_ANTIALIASING_COLOR_THRESHOLD
+        edges.narrow(axis, 0, size)[different] = True
+        edges.narrow(axis, 1, size)[different] = True
+    return edges
+
+def _render_adaptive(sdf_net, latent_codes, camera_positions, resolution, ssaa, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+        skip_empty_space, tile_size, shadow_iterations, buffer_dtype):
+    # Renders one ray through the center of each pixel and then ssaa x ssaa rays for each pixel on an edge, whose mean replaces its color.
+    # Returns the colors, depth, normals and positions like _render, the buffers are those of the rays through the centers of the pixels.
+    distance_bound = DistanceBound(sdf_net, latent_codes, size=radius) if skip_empty_space else None
+    pixels, depth, normals, positions, ground_planes = _render(sdf_net, latent_codes, camera_positions, resolution, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+        skip_empty_space, tile_size, shadow_iterations, distance_bound=distance_bound, ssaa=ssaa, return_buffers=True, buffer_dtype=buffer_dtype)
+
+    edges = _get_edges(pixels.reshape((-1, resolution, resolution, 3)), depth.reshape((-1, resolution, resolution)), normals.reshape((-1, resolution, resolution, 3)))
+    edge_pixels = torch.nonzero(edges.reshape(-1)).reshape(-1)
+    if edge_pixels.shape[0] > 0:
+        # The edges use the ground planes of the whole image
+        subpixels, _, _, _, _ = _render(sdf_net, latent_codes, camera_positions, resolution, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+            skip_empty_space, tile_size, shadow_iterations, distance_bound=distance_bound, ssaa=ssaa, pixel_indices=edge_pixels, subpixels=True, ground_planes=ground_planes)
+        pixels[edge_pixels, :] = torch.round(torch.mean(subpixels.reshape((-1, ssaa ** 2, 3)).to(torch.float32), dim=1)).to(torch.uint8)
+    return pixels, depth, normals, positions
+
+def _render_images_with_cache(cache, sdf_net, latent_codes, camera_positions, color, settings):
+    # Only the shapes with at least one missing view are rendered, with all of their views
+    colors = np.broadcast_to(np.array(color, dtype=float).reshape(-1, 3), (latent_codes.shape[0], 3))
+    # The tile size doesn't change the image, since every ray is traced independently of the other rays in its tile (see the tiling check in inference_accuracy.py)
+    key_settings = sorted((name, value) for name, value in settings.items() if name != 'tile_size')
+    parameter_fingerprint = sdf_net.get_parameter_fingerprint()
+    keys = [[cache.get_key('raymarching', parameter_fingerprint, getattr(sdf_net, 'inference_dtype', None), latent_code, np.asarray(position, dtype=float), light_position, colors[i], key_settings)
+        for position in camera_positions] for i, latent_code in enumerate(latent_codes)]
+    images = [[cache.get(key) for key in shape_keys] for shape_keys in keys]
+
+    missing = [i for i, shape_images in enumerate(images) if any(image is None for image in shape_images)]
+    if len(missing) > 0:
+        rendered_images = render_images(sdf_net, latent_codes[missing, :], camera_positions, color=colors[missing, :], **settings)
+        for i, shape_images in zip(missing, rendered_images):
+            for j, image in enumerate(shape_images):
+                cache.put(keys[i][j], image)
+                images[i][j] = image
+    return images
+
+def _get_image(pixels, resolution, ssaa, crop):
     if crop:
         from util import crop_image
-        pixels = crop_image(pixels, background=1)
+        pixels = crop_image(pixels, background=255)
 
-    image = Image.fromarray(np.uint8(pixels * 255) , 'RGB')
+    image = Image.fromarray(pixels, 'RGB')
 
     if ssaa != 1:
         image = image.resize((resolution, resolution), Image.ANTIALIAS)
 
     return image
 
+def render_image(sdf_net, latent_code, resolution=800, threshold=0.0005, sdf_offset=0, iterations=1000, ssaa=2, radius=1.0, crop=False, color=(0.8, 0.1, 0.1), vertical_cutoff=None, skip_empty_space=True, tile_size=RAYS_PER_TILE, shadow_iterations=SHADOW_ITERATIONS, adaptive_antialiasing=False, return_buffers=False, buffer_dtype=torch.float32, cache=None):
+    result = render_images(sdf_net, latent_code.unsqueeze(0), camera_position[np.newaxis, :], resolution=resolution, threshold=threshold, sdf_offset=sdf_offset,
+        iterations=iterations, ssaa=ssaa, radius=radius, crop=crop, color=color, vertical_cutoff=vertical_cutoff, skip_empty_space=skip_empty_space,
+        tile_size=tile_size, shadow_iterations=shadow_iterations, adaptive_antialiasing=adaptive_antialiasing, return_buffers=return_buffers, buffer_dtype=buffer_dtype, cache=cache)
+    if return_buffers:
+        images, buffers = result
+        return images[0][0], buffers[0][0]
+    return result[0][0]
 
-def render_image_for_index(sdf_net, latent_codes, index, crop=False, resolution=800):
-    ensure_directory('screenshots')
-    FILENAME = 'screenshots/raymarching-examples/image-{:d}-{:d}.png'
-    filename = FILENAME.format(index, resolution)
 
-    if os.path.isfile(filename):
-        return Image.open(filename)
-    
-    img = render_image(sdf_net, latent_codes[index], resolution=resolution, crop=crop)
-    img.save(filename)
-    return img
\ No newline at end of file
+def render_image_progressive(sdf_net, latent_code, resolution=800, levels=4, threshold=0.0005, sdf_offset=0, iterations=1000, ssaa=2, radius=1.0, crop=False, color=(0.8, 0.1, 0.1), vertical_cutoff=None, skip_empty_space=True, tile_size=RAYS_PER_TILE, shadow_iterations=SHADOW_ITERATIONS):
+    ''' Generator that yields images of increasing resolution, so that a preview can be shown early and refined while idle.
+    The first image has resolution / 2^(levels - 1) pixels per side and each further image twice as many.
+    The last image has the full resolution and is the only one that is supersampled.
+    The rays of each image start shortly in front of the hits of the previous image, instead of at the sphere. '''
+    latent_codes = latent_code.unsqueeze(0)
+    camera_positions = camera_position[np.newaxis, :]
+    # The distance bound is shared by all levels
+    distance_bound = DistanceBound(sdf_net, latent_codes, size=radius) if skip_empty_space else None
+
+    depth = None
+    for level in reversed(range(levels)):
+        level_resolution = max(1, resolution // 2 ** level)
+        level_ssaa = ssaa if level == 0 else 1
+        image_resolution = level_resolution * level_ssaa
+        start_depth = None if depth is None else _get_start_depth(depth, image_resolution)
+        pixels, depth, _, _, _ = _render(sdf_net, latent_codes, camera_positions, image_resolution, threshold, sdf_offset, iterations, radius, color, vertical_cutoff,
+            skip_empty_space, tile_size, shadow_iterations, start_depth=start_depth, distance_bound=distance_bound)
+        depth = depth.reshape((image_resolution, image_resolution))
+        yield _get_image(pixels.reshape((image_resolution, image_resolution, 3)).numpy(), level_resolution, level_ssaa, crop)
+
+def _get_start_depth(coarse_depth, resolution):
+    # Every ray of the finer image lies between four rays of the coarse image. It starts in front of the closest of their hits,
+    # or at the sphere (-inf) if one of them missed the model.
+    coarse_resolution = coarse_depth.shape[0]
+    if coarse_resolution < 2:
+        return None
+    coarse_depth = torch.where(torch.isinf(coarse_depth), float('-inf'), coarse_depth)
+    cell_depth = -F.max_pool2d(-coarse_depth.reshape(1, 1, coarse_resolution, coarse_resolution), 2, stride=1)[0, 0, :, :]
+    cells = (torch.arange(resolution) * (coarse_resolution - 1) / max(resolution - 1, 1)).long().clamp_(0, coarse_resolution - 2)
+    return cell_depth[cells.unsqueeze(1), cells.unsqueeze(0)] - PROGRESSIVE_DEPTH_MARGIN
+
+def render_image_for_index(sdf_net, latent_codes, index, crop=False, resolution=800, cache=None):
+    # The cache is addressed by the network parameters and the latent code, not by the index, so changed checkpoints or latent codes are rendered again
+    if cache is None:
+        cache = RenderCache()
+    return render_image(sdf_net, latent_codes[index], resolution=resolution, crop=crop, cache=cache)
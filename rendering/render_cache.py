@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Persistent cache for rendered images, used by rendering.raymarching.render_images and create_plot.ImageGrid.
+# Entries are addressed by a hash of everything that affects the image, such as the network parameters,
+# the latent code and the render settings, so changing any of them never returns a stale image.
+# Images are stored as PNG files next to an index file that records their size and when they were last used.
+# When the files exceed max_bytes, the least recently used ones are deleted.
+
+RENDER_CACHE_DIRECTORY = 'data/render_cache'
+INDEX_FILENAME = 'index.json'
+
+class RenderCache():
+    def __init__(self, directory=RENDER_CACHE_DIRECTORY, max_bytes=512 * 1024**2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index_filename = os.path.join(directory, INDEX_FILENAME)
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, 'r') as file:
+                self.index = json.load(file)
+        else:
+            self.index = {}
+
+    def get_key(self, *values):
+        # Tensors and arrays are hashed by their content, everything else by its repr
+        key = hashlib.sha1()
+        for value in values:
+            if isinstance(value, torch.Tensor):
+                value = value.detach().to(torch.float32).cpu().numpy()
+            if isinstance(value, np.ndarray):
+                key.update('{:s}{:s}'.format(str(value.dtype), str(value.shape)).encode())
+                key.update(np.ascontiguousarray(value).tobytes())
+            else:
+                key.update(repr(value).encode())
+        return key.hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def get(self, key):
+        if key in self.index and os.path.isfile(self._get_filename(key)):
+            image = Image.open(self._get_filename(key))
+            image.load()
+            self.index[key]['last_used'] = time.time()
+            self._write_index()
+            self.hits += 1
+            return image
+
+        if key in self.index:
+            # The file was deleted by someone else
+            del self.index[key]
+            self._write_index()
+        self.misses += 1
+        return None
+
+    def put(self, key, image):
+        filename = self._get_filename(key)
+        # Write to a temporary file first so that an interrupted write never leaves a corrupt entry
+        temporary_filename = filename + '.tmp.png'
+        image.save(temporary_filename, optimize=True)
+        os.replace(temporary_filename, filename)
+        self.index[key] = {'size': os.path.getsize(filename), 'last_used': time.time()}
+        self._evict()
+        self._write_index()
+
+    def _evict(self):
+        size = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index.keys(), key=lambda key: self.index[key]['last_used']):
+            if size <= self.max_bytes:
+                break
+            size -= self.index[key]['size']
+            del self.index[key]
+            if os.path.isfile(self._get_filename(key)):
+                os.remove(self._get_filename(key))
+
+    def _write_index(self):
+        temporary_filename = self.index_filename + '.tmp'
+        with open(temporary_filename, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(temporary_filename, self.index_filename)
+
+    def clear(self):
+        for key in list(self.index.keys()):
+            if os.path.isfile(self._get_filename(key)):
+                os.remove(self._get_filename(key))
+        self.index = {}
+        self._write_index()
@@ -62,7 +62,6 @@ fake_target_default = torch.zeros(BATCH_SIZE, requires_grad=False).to(device)
 
 def sample_latent_codes(current_batch_size):
     latent_codes = standard_normal_distribution.sample(sample_shape=[current_batch_size, LATENT_CODE_SIZE]).to(device)
-    latent_codes = latent_codes.repeat((1, 1, grid_points.shape[0])).reshape(-1, LATENT_CODE_SIZE)
     return latent_codes
 
 grid_points = get_voxel_coordinates(VOXEL_RESOLUTION, return_torch_tensor=True)
@@ -76,7 +75,7 @@ def train():
         for batch in tqdm(data_loader, desc='Epoch {:d}'.format(epoch)):
             try:
                 current_batch_size = batch.shape[0] # equals BATCH_SIZE for all batches except the last one
-                batch_grid_points = grid_points.repeat((current_batch_size, 1))
+                batch_grid_points = grid_points.expand(current_batch_size, -1, -1)
 
                 # train generator
                 generator_optimizer.zero_grad()
@@ -145,7 +144,7 @@ def train():
 
         if "show_slice" in sys.argv:
             latent_code = sample_latent_codes(1)
-            voxels = generator(grid_points, latent_code)
+            voxels = generator(grid_points.unsqueeze(0), latent_code)
             voxels = voxels.reshape(VOXEL_RESOLUTION, VOXEL_RESOLUTION, VOXEL_RESOLUTION)
             print(create_text_slice(voxels / SDF_CLIPPING))
         
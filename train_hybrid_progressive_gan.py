@@ -89,11 +89,9 @@ if show_viewer:
 
 def sample_latent_codes(current_batch_size):
     latent_codes = standard_normal_distribution.sample(sample_shape=[current_batch_size, LATENT_CODE_SIZE]).to(device)
-    latent_codes = latent_codes.repeat((1, 1, grid_points.shape[0])).reshape(-1, LATENT_CODE_SIZE)
     return latent_codes
 
 grid_points = get_voxel_coordinates(VOXEL_RESOLUTION, return_torch_tensor=True)
-grid_points_default_batch = grid_points.repeat((BATCH_SIZE, 1))
 
 history_fake = deque(maxlen=50)
 history_real = deque(maxlen=50)
@@ -123,10 +121,7 @@ def train():
                     continue
                 valid_sample = valid_sample.to(device)
                 current_batch_size = valid_sample.shape[0]
-                if current_batch_size == BATCH_SIZE:
-                    batch_grid_points = grid_points_default_batch
-                else:
-                    batch_grid_points = grid_points.repeat((current_batch_size, 1))
+                batch_grid_points = grid_points.expand(current_batch_size, -1, -1)
 
                 if not CONTINUE and ITERATION > 0:
                     discriminator.fade_in_progress = (epoch + batch_index / (len(dataset) / BATCH_SIZE)) / FADE_IN_EPOCHS
@@ -203,7 +198,7 @@ def train():
 
         if "show_slice" in sys.argv:
             latent_code = sample_latent_codes(1)
-            slice_voxels = generator_parallel(grid_points, latent_code)
+            slice_voxels = generator_parallel(grid_points.unsqueeze(0), latent_code)
             slice_voxels = slice_voxels.reshape(VOXEL_RESOLUTION, VOXEL_RESOLUTION, VOXEL_RESOLUTION)
             tqdm.write(create_text_slice(slice_voxels / SDF_CLIPPING))
         
@@ -66,10 +66,9 @@ fake_target = torch.zeros(BATCH_SIZE, requires_grad=False).to(device)
 
 def sample_latent_codes():
     latent_codes = standard_normal_distribution.sample(sample_shape=[BATCH_SIZE, LATENT_CODE_SIZE]).to(device)
-    latent_codes = latent_codes.repeat((1, 1, VOXEL_RESOLUTION**3)).reshape(-1, LATENT_CODE_SIZE)
     return latent_codes
 
-grid_points = get_voxel_coordinates(VOXEL_RESOLUTION, return_torch_tensor=True).repeat((BATCH_SIZE, 1))
+grid_points = get_voxel_coordinates(VOXEL_RESOLUTION, return_torch_tensor=True).expand(BATCH_SIZE, -1, -1)
 history_fake = deque(maxlen=50)
 history_real = deque(maxlen=50)
 
@@ -38,6 +38,32 @@ def get_points_in_unit_sphere(n, device):
         print("Warning: Did not find enough points.")
     return x
 
+def sample_surface_points(vertices, faces, point_count, generator=None):
+    # Samples points uniformly on a triangle mesh given as tensors, with a torch.Generator for reproducible results
+    triangles = vertices[faces, :]
+    edges1 = triangles[:, 1, :] - triangles[:, 0, :]
+    edges2 = triangles[:, 2, :] - triangles[:, 0, :]
+    areas = torch.norm(torch.cross(edges1, edges2, dim=1), dim=1)
+    indices = torch.multinomial(areas.cpu(), point_count, replacement=True, generator=generator).to(vertices.device)
+    u, v = torch.rand((2, point_count, 1), generator=generator).to(vertices.device)
+    outside = (u + v > 1).to(vertices.dtype)
+    u, v = u + outside * (1 - 2 * u), v + outside * (1 - 2 * v)
+    return triangles[indices, 0, :] + u * edges1[indices, :] + v * edges2[indices, :]
+
+def evaluate_on_grid(model, latent_codes, voxel_resolution, batch_size=100000):
+    # Returns the SDF values of shape (latent code count, voxel_resolution**3) for a SDFNet or SDFGenerator
+    points = get_voxel_coordinates(voxel_resolution, return_torch_tensor=True).to(latent_codes.device)
+    if hasattr(model, 'evaluate_multiple_in_batches'):
+        return model.evaluate_multiple_in_batches(points, latent_codes, batch_size=batch_size, return_cpu_tensor=False)
+
+    result = torch.zeros((latent_codes.shape[0], points.shape[0]), device=points.device)
+    with torch.no_grad():
+        for i in range(latent_codes.shape[0]):
+            for start in range(0, points.shape[0], batch_size):
+                batch_points = points[start:start + batch_size, :].unsqueeze(0)
+                result[i, start:start + batch_size] = model(batch_points, latent_codes[i:i + 1, :]).reshape(-1)
+    return result
+
 def crop_image(image, background=255):
     mask = image[:, :] != background
     coords = np.array(np.nonzero(mask))